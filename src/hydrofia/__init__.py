@@ -1,12 +1,22 @@
 import pathlib
 
+import pandas as pd
+
 from hydrofia.calculate import Calculate
+from hydrofia.calculate import get_ctd_matches
 from hydrofia.ctd import CtdStandardFormatCollection
+from hydrofia import cache
 from hydrofia import exporter
 from hydrofia.exporter import ExporterTxt
 from hydrofia.exporter import ExporterXlsxResultFile
+from hydrofia.hydrofia import HydrofiaExportFileCollection
 from hydrofia.hydrofia import HydrofiaExportFileDiscrete
+from hydrofia.hydrofia import HydrofiaExportFileSummary
+from hydrofia.hydrofia import HydrofiaPickleTemplate
+from hydrofia.hydrofia import HydrofiaTextTemplate
 from hydrofia.hydrofia import HyrdofiaExcelTemplate
+from hydrofia.hydrofia import get_template
+from hydrofia.hydrofia import get_export_file_summary
 from hydrofia import utils
 
 
@@ -15,43 +25,86 @@ def get_default_template_path(directory: pathlib.Path | str = None) -> pathlib.P
 
 
 def create_template(template_path: pathlib.Path | str = None,
-                    hydrofia_export_path: pathlib.Path | str = None,
+                    hydrofia_export_path: pathlib.Path | str | list[pathlib.Path | str] = None,
                     overwrite: bool = False,
                     year: int = None,
-                    month: int = None):
+                    month: int = None,
+                    ctd_directory: pathlib.Path | str = None,
+                    **kwargs):
+    """hydrofia_export_path can also be a list of export files or a directory with export files.
+    The template format is given by the suffix of template_path, see hydrofia.hydrofia.get_template.
+    If ctd_directory is given the ctd data is matched (with the same kwargs as in get_calculated_object) and
+    stored in the template. The matches are then reused when the result is created."""
     start_date, end_date = utils.get_date_limits_from_year_and_month(year=year, month=month)
-    template = HyrdofiaExcelTemplate(template_path)
-    hf = HydrofiaExportFileDiscrete(hydrofia_export_path)
+    template = get_template(template_path)
+    if isinstance(hydrofia_export_path, (list, tuple)) or pathlib.Path(hydrofia_export_path).is_dir():
+        hf = HydrofiaExportFileCollection(hydrofia_export_path)
+    else:
+        hf = HydrofiaExportFileDiscrete(hydrofia_export_path)
     hf.filter_data_by_date(start_date=start_date, end_date=end_date)
-    return template.create_template(hf, overwrite=overwrite)
+    ctd_matches = None
+    if ctd_directory:
+        ctd_obj = _get_ctd_collection(ctd_directory, **kwargs)
+        ctd_matches = get_ctd_matches(hf.get_data(), ctd_obj)
+    return template.create_template(hf, overwrite=overwrite, ctd_matches=ctd_matches)
+
+
+def get_template_corrections(template_path: pathlib.Path | str = None) -> pd.DataFrame:
+    """Returns a boolean frame, indexed by template sheet row, that is True where a correction column has been
+    changed by the user"""
+    return HyrdofiaExcelTemplate(template_path).get_corrections()
+
+
+def highlight_template_corrections(template_path: pathlib.Path | str = None,
+                                   save_path: pathlib.Path | str = None) -> list[int]:
+    """Saves the template (to save_path if given) with the corrected cells highlighted.
+    Returns the template sheet rows with corrections."""
+    return HyrdofiaExcelTemplate(template_path).highlight_corrections(path=save_path)
 
 
 def get_id_string_for_hydrofia_export_file(path: pathlib.Path | str = None,
                                            year: int = None,
                                            month: int = None):
     start_date, end_date = utils.get_date_limits_from_year_and_month(year=year, month=month)
-    hf = HydrofiaExportFileDiscrete(path)
-    hf.filter_data_by_date(start_date=start_date, end_date=end_date)
-    info = hf.get_info()
+    summary = get_export_file_summary(path)
+    info = summary.get_info(year=start_date.year, month=month)
     if not info:
         return
     stem = f"{info['year_string']}_{info['from_serno']}_{info['to_serno']}"
     return stem
 
 
+def get_years_in_hydrofia_export_file(path: pathlib.Path | str = None) -> list[int]:
+    return get_export_file_summary(path).years
+
+
+def get_months_in_hydrofia_export_file(path: pathlib.Path | str = None, year: int = None) -> list[int]:
+    return get_export_file_summary(path).get_months(year)
+
+
+def _get_ctd_collection(ctd_directory: pathlib.Path | str, **kwargs) -> CtdStandardFormatCollection:
+    return CtdStandardFormatCollection(ctd_directory,
+                                       max_depth_diff_allowed=kwargs.get('max_depth_diff_allowed'),
+                                       surface_layer_depth=kwargs.get('surface_layer_depth'),
+                                       bottom_layer_depth=kwargs.get('bottom_layer_depth'),
+                                       )
+
+
 def get_calculated_object(
         template_path: pathlib.Path | str = None,
         ctd_directory: pathlib.Path | str = None,
         **kwargs):
     """Returns a Calculate object calculated with info from template and ctd_directory"""
-    template = HyrdofiaExcelTemplate(template_path)
-    ctd_obj = CtdStandardFormatCollection(ctd_directory,
-                                          max_depth_diff_allowed=kwargs.get('max_depth_diff_allowed'),
-                                          surface_layer_depth=kwargs.get('surface_layer_depth'),
-                                          bottom_layer_depth=kwargs.get('bottom_layer_depth'),
-                                          )
+    template = get_template(template_path)
+    ctd_obj = _get_ctd_collection(ctd_directory, **kwargs)
+    result_key = None
+    if kwargs.get('use_previous_result', True):
+        # Rows that are unchanged since the last result for this template and ctd data are not calculated again
+        result_key = cache.get_key(Calculate.RESULT_CACHE_VERSION, template.path.resolve(),
+                                   ctd_obj.directory.resolve(), ctd_obj.get_fingerprint())
     calc = Calculate(hydrofia_data=template,
-                     salinity_and_temp_data=ctd_obj)
+                     salinity_and_temp_data=ctd_obj,
+                     result_key=result_key)
     calc.calculate()
     return calc
 
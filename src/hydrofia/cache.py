@@ -0,0 +1,183 @@
+import collections
+import hashlib
+import json
+import logging
+import pathlib
+from typing import Callable, Hashable
+
+import pandas as pd
+
+from hydrofia import utils
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FILE_CACHE_DIRECTORY = pathlib.Path(utils.get_user_cache_directory(), 'export_files')
+EXPORT_FILE_CACHE_MAX_SIZE = 500 * 1024 * 1024  # bytes
+RESULT_CACHE_DIRECTORY = pathlib.Path(utils.get_user_cache_directory(), 'results')
+RESULT_CACHE_MAX_SIZE = 100 * 1024 * 1024  # bytes
+TEMPLATE_CACHE_DIRECTORY = pathlib.Path(utils.get_user_cache_directory(), 'templates')
+TEMPLATE_CACHE_MAX_SIZE = 200 * 1024 * 1024  # bytes
+TEMPLATE_CACHE_MAX_ENTRIES = 20
+TEMPLATE_DATA_CACHE_MAX_ENTRIES = 8
+
+
+def get_key(*args) -> str:
+    return hashlib.sha1('|'.join([str(arg) for arg in args]).encode()).hexdigest()
+
+
+class MemoryLRUCache:
+    """Least recently used cache in memory. The least recently used entries are removed when the number of
+    entries exceeds max_entries or the total size exceeds max_size. The size of an entry is given by
+    get_size(key, value) and must be given if max_size is used."""
+
+    def __init__(self, max_entries: int = None, max_size: int = None,
+                 get_size: Callable[[Hashable, object], int] = None) -> None:
+        if max_size and get_size is None:
+            raise ValueError('get_size must be given together with max_size')
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self._get_size = get_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries: collections.OrderedDict[Hashable, tuple[object, int]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> object | None:
+        """Returns the value for key. Use "key in cache" to tell a cached None from a miss."""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value: object) -> None:
+        if key in self._entries:
+            self.size -= self._entries.pop(key)[1]
+        size = self._get_size(key, value) if self._get_size else 0
+        self._entries[key] = (value, size)
+        self.size += size
+        while self._entries and ((self.max_entries and len(self._entries) > self.max_entries) or
+                                 (self.max_size and self.size > self.max_size)):
+            self.size -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self) -> dict[str, int]:
+        return dict(entries=len(self._entries), size=self.size, hits=self.hits, misses=self.misses)
+
+
+class DataFrameDiskCache:
+    """Stores data frames as pickle files together with a small json file of metadata.
+    Used entries are touched so that the least recently used ones are removed when the total size
+    of the cache exceeds max_size or the number of entries exceeds max_entries."""
+
+    def __init__(self, directory: str | pathlib.Path, max_size: int = None, max_entries: int = None) -> None:
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.max_entries = max_entries
+
+    def _get_meta_path(self, key: str) -> pathlib.Path:
+        return pathlib.Path(self.directory, f'{key}.json')
+
+    def _get_data_path(self, key: str) -> pathlib.Path:
+        return pathlib.Path(self.directory, f'{key}.pkl')
+
+    def get_meta(self, key: str) -> dict | None:
+        path = self._get_meta_path(key)
+        if not path.exists():
+            return None
+        try:
+            with open(path) as fid:
+                return json.load(fid)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not read cache metadata {path}: {e}')
+            return None
+
+    def get_data(self, key: str) -> pd.DataFrame | None:
+        path = self._get_data_path(key)
+        if not path.exists():
+            return None
+        try:
+            data = pd.read_pickle(path)
+            path.touch()
+            return data
+        except Exception as e:
+            logger.warning(f'Could not read cached data {path}: {e}')
+            self.remove(key)
+            return None
+
+    def put(self, key: str, data: pd.DataFrame, meta: dict) -> None:
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            data.to_pickle(self._get_data_path(key))
+            with open(self._get_meta_path(key), 'w') as fid:
+                json.dump(meta, fid)
+        except OSError as e:
+            logger.warning(f'Could not write to cache {self.directory}: {e}')
+            self.remove(key)
+            return
+        try:
+            self._evict(keep=key)
+        except OSError as e:
+            logger.warning(f'Could not evict old entries from cache {self.directory}: {e}')
+
+    def remove(self, key: str) -> None:
+        for path in [self._get_meta_path(key), self._get_data_path(key)]:
+            path.unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        if not self.directory.exists():
+            return
+        for path in self.directory.glob('*.pkl'):
+            self.remove(path.stem)
+
+    def _evict(self, keep: str = None) -> None:
+        if not self.max_size and not self.max_entries:
+            return
+        entries = []
+        total_size = 0
+        for path in self.directory.glob('*.pkl'):
+            meta_path = self._get_meta_path(path.stem)
+            try:
+                stat = path.stat()
+                size = stat.st_size + meta_path.stat().st_size
+            except FileNotFoundError:
+                # Removed by another process or thread sharing the cache directory
+                continue
+            entries.append((stat.st_mtime, path.stem, size))
+            total_size += size
+        nr_entries = len(entries)
+        for _, key, size in sorted(entries):
+            if (not self.max_size or total_size <= self.max_size) and \
+                    (not self.max_entries or nr_entries <= self.max_entries):
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total_size -= size
+            nr_entries -= 1
+
+
+def get_export_file_cache() -> DataFrameDiskCache:
+    return DataFrameDiskCache(EXPORT_FILE_CACHE_DIRECTORY, max_size=EXPORT_FILE_CACHE_MAX_SIZE)
+
+
+def get_result_cache() -> DataFrameDiskCache:
+    return DataFrameDiskCache(RESULT_CACHE_DIRECTORY, max_size=RESULT_CACHE_MAX_SIZE)
+
+
+def get_template_cache() -> DataFrameDiskCache:
+    return DataFrameDiskCache(TEMPLATE_CACHE_DIRECTORY, max_size=TEMPLATE_CACHE_MAX_SIZE,
+                              max_entries=TEMPLATE_CACHE_MAX_ENTRIES)
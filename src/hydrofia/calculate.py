@@ -1,9 +1,13 @@
+import logging
 from typing import Protocol, runtime_checkable
 import pandas as pd
 import numpy as np
 from typing import Type
+from hydrofia import cache
 from hydrofia.ext_src import seacarb
 
+logger = logging.getLogger(__name__)
+
 
 class HydrofiaTemplateData(Protocol):
 
@@ -18,6 +22,57 @@ class SalinityAndTemperatureData(Protocol):
         ...
 
 
+def get_float(val):
+    try:
+        return float(val)
+    except ValueError:
+        return val
+
+
+def get_ctd_lookup(row: pd.Series) -> dict | None:
+    """Arguments to SalinityAndTemperatureData.get_ctd_data for a data row with float depth.
+    None for CRM samples."""
+    if 'CRM' in row['serno'].upper():
+        return None
+    depth = row['depth']
+    if type(depth) == str:
+        depth = get_float(depth.split('/')[0])  # If replicate
+    if type(depth) == str and depth.upper() == 'DIB':
+        depth = 'deepest'
+    return dict(year=row['year'],
+                ship=row['country'] + row['ship'],
+                serno=row['serno'],
+                depth=depth)
+
+
+def get_ctd_lookup_key(lookup: dict) -> str:
+    return '_'.join(str(lookup[key]) for key in ['year', 'ship', 'serno', 'depth'])
+
+
+def get_ctd_matches(data: pd.DataFrame, salinity_and_temp_data: SalinityAndTemperatureData) -> list[dict | None]:
+    """Looks up the CTD data for all rows in data (as given to a template). Each match holds the lookup key,
+    the fingerprint of the ctd file and the ctd data so that Calculate can reuse it while both are unchanged."""
+    data = data.copy()
+    data['depth'] = data['depth'].apply(get_float)
+    matches = []
+    for _, row in data.iterrows():
+        lookup = get_ctd_lookup(row)
+        if lookup is None or (type(lookup['depth']) == str and lookup['depth'] != 'deepest'):
+            # CRM, removed (depth X) or to be corrected by the user
+            matches.append(None)
+            continue
+        fingerprint = salinity_and_temp_data.get_file_fingerprint(year=lookup['year'],
+                                                                  ship=lookup['ship'],
+                                                                  serno=lookup['serno'])
+        if fingerprint is None:
+            matches.append(None)
+            continue
+        matches.append(dict(key=get_ctd_lookup_key(lookup),
+                            fingerprint=fingerprint,
+                            data=salinity_and_temp_data.get_ctd_data(**lookup)))
+    return matches
+
+
 @runtime_checkable
 class Exporter(Protocol):
 
@@ -26,12 +81,23 @@ class Exporter(Protocol):
 
 
 class Calculate:
+    RESULT_COLUMNS = ['salt', 'temp', 'ref_depth', 'station', 'calc_pH']
+    ROW_HASH_COLUMN = 'row_hash'
+    # Increase when the calculation or the ctd lookup changes so that old results are not reused
+    RESULT_CACHE_VERSION = 1
+
     def __init__(self,
                  hydrofia_data: HydrofiaTemplateData = None,
-                 salinity_and_temp_data: SalinityAndTemperatureData = None):
+                 salinity_and_temp_data: SalinityAndTemperatureData = None,
+                 result_key: str = None):
+        """If result_key is given the result is saved under that key. The next calculation with the same key
+        then only calculates rows that have changed, given that hydrofia_data has get_row_hashes."""
         self.data_hydrofia = hydrofia_data
         self.data_salt_temp = salinity_and_temp_data
+        self._result_key = result_key
         self._data: pd.DataFrame = pd.DataFrame()
+        self._row_hashes = None
+        self._previous_results: list[dict | None] = []
 
     @property
     def data(self):
@@ -40,10 +106,12 @@ class Calculate:
     def calculate(self):
         self._extract_data()
         self._make_float()
+        self._set_previous_results()
         self._add_salt_and_temp()
         # print('AAA', self._data['salt'])
         self._calculate()
         # print('BBB', self._data['salt'])
+        self._save_result()
 
     def _extract_data(self):
         # all_data = self.data_hydrofia.get_data()
@@ -51,35 +119,53 @@ class Calculate:
         # self._data = all_data[['timestamp', 'year', 'date', 'ship', 'serno', 'depth', 'Rspec']].copy(deep=True)
 
     def _make_float(self):
-        def get_float(val):
-            try:
-                return float(val)
-            except ValueError:
-                return val
         self._data['depth'] = self._data['depth'].apply(get_float)
-        self._data['Rspec'] = self._data['Rspec'].apply(float)
+        self._data['Rspec'] = self._data['Rspec'].astype(float)
+
+    def _set_previous_results(self):
+        """Finds the rows that are unchanged since the saved result. These are not calculated again."""
+        self._previous_results = [None] * len(self._data)
+        get_row_hashes = getattr(self.data_hydrofia, 'get_row_hashes', None)
+        if not self._result_key or not get_row_hashes:
+            return
+        self._row_hashes = get_row_hashes()
+        previous = cache.get_result_cache().get_data(self._result_key)
+        if previous is None:
+            return
+        previous = previous.drop_duplicates(self.ROW_HASH_COLUMN).set_index(self.ROW_HASH_COLUMN)
+        records = previous.to_dict('index')
+        self._previous_results = [records.get(row_hash) for row_hash in self._row_hashes]
+        nr_reused = sum(result is not None for result in self._previous_results)
+        logger.info(f'Calculating {len(self._data) - nr_reused} of {len(self._data)} rows')
+
+    def _save_result(self):
+        if self._row_hashes is None:
+            return
+        result = self._data[self.RESULT_COLUMNS].copy()
+        result[self.ROW_HASH_COLUMN] = self._row_hashes
+        cache.get_result_cache().put(self._result_key, result, meta={})
 
     def _add_salt_and_temp(self):
         salt_data = []
         temp_data = []
         ref_depth_data = []
         station_data = []
-        for index, row in self.data.iterrows():
-            if 'CRM' in row['serno'].upper():
+        ctd_matches = self._get_template_ctd_matches()
+        fingerprints = {}
+        for (index, row), previous, ctd_match in zip(self.data.iterrows(), self._previous_results, ctd_matches):
+            if previous is not None:
+                data = dict((key, previous[key]) for key in ['salt', 'temp', 'station'])
+                data['depth'] = previous['ref_depth']
+            elif 'CRM' in row['serno'].upper():
                 data = dict(
                     salt=float(row['salinity']),
                     temp=float(row['temperatureSample'])
                 )
             else:
-                depth = row['depth']
-                if type(depth) == str:
-                    depth = depth.split('/')[0]  # If replicate
-                if type(depth) == str and depth.upper() == 'DIB':
-                    depth = 'deepest'
-                data = self.data_salt_temp.get_ctd_data(year=row['year'],
-                                                        ship=row['country'] + row['ship'],
-                                                        serno=row['serno'],
-                                                        depth=depth)
+                lookup = get_ctd_lookup(row)
+                data = self._get_matched_ctd_data(lookup, ctd_match, fingerprints)
+                if data is None:
+                    data = self.data_salt_temp.get_ctd_data(**lookup)
             # raise
             salt_data.append(data.get('salt', ''))
             temp_data.append(data.get('temp', ''))
@@ -90,13 +176,35 @@ class Calculate:
         self._data['ref_depth'] = ref_depth_data
         self._data['station'] = station_data
 
+    def _get_template_ctd_matches(self) -> list[dict | None]:
+        get_matches = getattr(self.data_hydrofia, 'get_ctd_matches', None)
+        if not get_matches or not hasattr(self.data_salt_temp, 'get_file_fingerprint'):
+            return [None] * len(self._data)
+        return get_matches()
+
+    def _get_matched_ctd_data(self, lookup: dict, ctd_match: dict | None, fingerprints: dict) -> dict | None:
+        """Returns the ctd data matched when the template was created if the depth, serno etc. are unedited
+        and the ctd file is unchanged"""
+        if not ctd_match or ctd_match['key'] != get_ctd_lookup_key(lookup):
+            return None
+        file_key = (lookup['year'], lookup['ship'], lookup['serno'])
+        if file_key not in fingerprints:
+            fingerprints[file_key] = self.data_salt_temp.get_file_fingerprint(*file_key)
+        if ctd_match['fingerprint'] != fingerprints[file_key]:
+            return None
+        return ctd_match['data']
+
     def _calculate(self):
         def calc_pHTspec(row):
             if not all([row['salt'], row['temp'], row['Rspec']]):
                 return np.nan
             return seacarb.pHTspec(row['salt'], row['temp'], row['Rspec'], 'mosley')
         # self._data['calc_pH'] = self._data.apply(calc_pHTspec, axis=1).apply(lambda x: str(x).replace(',', '.'))
-        self._data['calc_pH'] = self._data.apply(calc_pHTspec, axis=1)
+        if not any(result is not None for result in self._previous_results):
+            self._data['calc_pH'] = self._data.apply(calc_pHTspec, axis=1)
+            return
+        self._data['calc_pH'] = [calc_pHTspec(row) if previous is None else previous['calc_pH']
+                                 for (_, row), previous in zip(self._data.iterrows(), self._previous_results)]
 
     def save_data(self, exporters: list[Exporter] | Exporter, **kwargs) -> None:
         if isinstance(exporters, Exporter):
@@ -1,13 +1,22 @@
+import collections
+import hashlib
 import pathlib
+import sys
 from typing import Tuple, Any
 
 import pandas as pd
 import datetime
 import numpy as np
-from functools import cached_property, cache
+from functools import cached_property
+
+from hydrofia import cache
 
 EXCLUDE_QUALITY_FLAGS = ['B']
 
+QUERY_CACHE_MAX_ENTRIES = 100_000
+QUERY_CACHE_MAX_SIZE = 20 * 1024 * 1024  # bytes
+PROFILE_MEMORY_BUDGET = 500 * 1024 * 1024  # bytes
+
 SHIP_MAPPER = {
     '7710': '77SE'
 }
@@ -21,6 +30,135 @@ def get_key(**kwargs):
     return f'{kwargs.get("year")}_{get_mapped_ship(kwargs.get("ship"))}_{kwargs.get("serno")}'
 
 
+def get_decimal_degrees(position: str | None) -> float | None:
+    """Converts a position given as DDMM.mm (as in LATIT and LONGI) to decimal degrees"""
+    try:
+        value = float(position)
+    except (TypeError, ValueError):
+        return None
+    degrees = int(value / 100)
+    return degrees + (value - degrees * 100) / 60
+
+
+def _get_query_size(key: tuple, record: tuple | None) -> int:
+    """Estimated size (bytes) of a ctd query cache entry. Only small records (salt, temp, depth, station) are
+    stored, None for queries without data."""
+    size = sys.getsizeof(key) + sum(sys.getsizeof(item) for item in key)
+    if record is not None:
+        size += sys.getsizeof(record) + sum(sys.getsizeof(item) for item in record)
+    return size
+
+
+class CtdProfile:
+    """Depth, salinity and temperature of a parsed ctd cast after quality control. The arrays are sorted by
+    depth with rows of equal depth in file order, and rows without depth are left out. row is the position of
+    each value in the file and last_depth the depth of the last row in the file."""
+    __slots__ = ('depth', 'salt', 'temp', 'row', 'last_depth', 'station', 'date', 'ship', 'serno')
+
+    def __init__(self,
+                 depth: np.ndarray,
+                 salt: np.ndarray,
+                 temp: np.ndarray,
+                 row: np.ndarray,
+                 last_depth: float = np.nan,
+                 station: str = None,
+                 date: datetime.date = None,
+                 ship: str = None,
+                 serno: str = None,
+                 ):
+        self.depth = depth
+        self.salt = salt
+        self.temp = temp
+        self.row = row
+        self.last_depth = last_depth
+        self.station = station
+        self.date = date
+        self.ship = ship
+        self.serno = serno
+
+    @classmethod
+    def from_arrays(cls,
+                    depth: np.ndarray,
+                    salt: np.ndarray,
+                    temp: np.ndarray,
+                    dtype: type = np.float64,
+                    **kwargs) -> 'CtdProfile':
+        """Creates a profile from arrays in file order. dtype can be np.float32 to halve the memory used."""
+        depth = np.asarray(depth, dtype=np.float64)
+        order = np.argsort(depth, kind='stable')
+        order = order[~np.isnan(depth[order])]
+        return cls(depth=np.ascontiguousarray(depth[order], dtype=dtype),
+                   salt=np.ascontiguousarray(np.asarray(salt)[order], dtype=dtype),
+                   temp=np.ascontiguousarray(np.asarray(temp)[order], dtype=dtype),
+                   row=order.astype(np.int32),
+                   last_depth=float(depth[-1]) if len(depth) else np.nan,
+                   **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.depth)
+
+    @property
+    def nbytes(self) -> int:
+        return self.depth.nbytes + self.salt.nbytes + self.temp.nbytes + self.row.nbytes
+
+    def _get_nearest_position(self, depth: float, start: int, end: int) -> tuple[int, float]:
+        """Returns the position, among positions start to end, of the depth nearest to the given depth
+        together with the depth difference. If several rows are equally near, the one first in the file is used."""
+        index = min(max(int(np.searchsorted(self.depth, depth)), start), end)
+        diffs = []
+        if index > start:
+            diffs.append(abs(self.depth[index - 1] - depth))
+        if index < end:
+            diffs.append(abs(self.depth[index] - depth))
+        min_diff = min(diffs)
+        first = index
+        while first > start and abs(self.depth[first - 1] - depth) == min_diff:
+            first -= 1
+        last = index
+        while last < end and abs(self.depth[last] - depth) == min_diff:
+            last += 1
+        return first + int(np.argmin(self.row[first:last])), min_diff
+
+    def get_position_at_depth(self,
+                              depth: float,
+                              max_depth_diff_allowed: float = None,
+                              surface_layer_depth: float = None,
+                              bottom_layer_depth: float = None,
+                              ) -> int | None:
+        start = 0
+        end = len(self.depth)
+        if not end or np.isnan(depth):
+            return None
+        bottom_layer_top = None
+        if bottom_layer_depth:
+            bottom_layer_top = self.last_depth - bottom_layer_depth
+        if surface_layer_depth and depth <= surface_layer_depth:
+            end = int(np.searchsorted(self.depth, surface_layer_depth, side='right'))
+            max_depth_diff_allowed = None
+        elif bottom_layer_top and depth >= bottom_layer_top:
+            start = int(np.searchsorted(self.depth, bottom_layer_depth, side='left'))
+            max_depth_diff_allowed = None
+        if start >= end:
+            return None
+        position, min_diff = self._get_nearest_position(depth, start, end)
+        if max_depth_diff_allowed and min_diff > max_depth_diff_allowed:
+            return None
+        return position
+
+    def get_position_at_deepest_depth(self) -> int | None:
+        end = len(self.depth)
+        if not end:
+            return None
+        first = int(np.searchsorted(self.depth, self.depth[-1], side='left'))
+        return first + int(np.argmin(self.row[first:end]))
+
+    def get_data_at_position(self, position: int) -> dict:
+        return dict(salt=float(self.salt[position]),
+                    temp=float(self.temp[position]),
+                    depth=float(self.depth[position]),
+                    station=self.station)
+
+
 class CtdStandardFormat:
     DEPTH_PAR = 'DEPH [m]'
     DEPTH_QF_PAR = 'QV:SMHI:DEPH [m]'
@@ -29,9 +167,11 @@ class CtdStandardFormat:
     SALT_QF_PAR = 'QV:SMHI:SALT_CTD [psu]'
     TEMP_PAR = 'TEMP_CTD [°C (ITS-90)]'
     TEMP_QF_PAR = 'QV:SMHI:TEMP2_CTD [°C (ITS-90)]'
+    ENCODING = 'cp1252'
 
-    def __init__(self, path: pathlib.Path):
+    def __init__(self, path: pathlib.Path, dtype: type = np.float64):
         self.path = path
+        self.dtype = dtype
 
     @cached_property
     def date(self) -> datetime.date:
@@ -53,65 +193,104 @@ class CtdStandardFormat:
     def key(self):
         return get_key(year=self.year, ship=self.ship, serno=self.serno)
 
+    @property
+    def metadata(self) -> dict[str, str]:
+        """The //METADATA;KEY;VALUE lines of the file as {KEY: VALUE}"""
+        return self._content[0]
+
+    @property
+    def profile(self) -> CtdProfile:
+        return self._content[1]
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """Depth, salinity and temperature of the profile in file order"""
+        profile = self.profile
+        order = np.argsort(profile.row)
+        return pd.DataFrame({
+            self.DEPTH_PAR: profile.depth[order],
+            self.SALT_PAR: profile.salt[order],
+            self.TEMP_PAR: profile.temp[order],
+            'depth': profile.depth[order],
+        })
+
+    @cached_property
+    def station(self) -> str | None:
+        return self.metadata.get('STATN')
+
     @cached_property
-    def station(self):
-        with open(self.path, encoding='cp1252') as fid:
-            for line in fid:
-                if 'STATN' in line:
-                    return line.split(';')[-1].strip()
+    def instrument(self) -> str | None:
+        return self.metadata.get('INSTRUMENT')
 
     @cached_property
-    def data(self):
-        header = []
-        data_lines = []
-        with open(self.path, encoding='cp1252') as fid:
-            for line in fid:
-                if line.startswith('//'):
-                    continue
-                split_line = line.split('\t')
-                if not header:
-                    header = split_line
-                    continue
-                data_lines.append(split_line)
-        df = pd.DataFrame(data_lines, columns=header)
-        df['depth'] = df[self.DEPTH_PAR].astype(float)
+    def latitude(self) -> float | None:
+        """Decimal degrees"""
+        return get_decimal_degrees(self.metadata.get('LATIT'))
+
+    @cached_property
+    def longitude(self) -> float | None:
+        """Decimal degrees"""
+        return get_decimal_degrees(self.metadata.get('LONGI'))
+
+    @cached_property
+    def cast_time(self) -> datetime.datetime | None:
+        try:
+            return datetime.datetime.strptime(f'{self.metadata["SDATE"]} {self.metadata["STIME"]}', '%Y-%m-%d %H:%M')
+        except (KeyError, ValueError):
+            return None
+
+    @cached_property
+    def _content(self) -> tuple[dict[str, str], CtdProfile]:
+        """Reads the metadata and the data in one pass over the file. Only the depth, salinity and temperature
+        columns are read. Rows where salinity or temperature has a quality flag in EXCLUDE_QUALITY_FLAGS are
+        removed."""
+        metadata = {}
+        with open(self.path, encoding=self.ENCODING) as fid:
+            line = fid.readline()
+            while line.startswith('//'):
+                parts = line[2:].rstrip('\r\n').split(';', 2)
+                if len(parts) == 3 and parts[0] == 'METADATA':
+                    metadata[parts[1]] = parts[2].strip()
+                line = fid.readline()
+            header = line.rstrip('\r\n').split('\t')
+            df = pd.read_csv(fid,
+                             sep='\t',
+                             header=None,
+                             names=header,
+                             usecols=[self.DEPTH_PAR, self.SALT_PAR, self.SALT_QF_PAR, self.TEMP_PAR, self.TEMP_QF_PAR],
+                             dtype={self.SALT_QF_PAR: str, self.TEMP_QF_PAR: str},
+                             engine='c',
+                             float_precision='round_trip')
         # df['press'] = df[self.PRESS_PAR].astype(float)
 
         # Filter data
         salt_boolean = ~df[self.SALT_QF_PAR].isin(EXCLUDE_QUALITY_FLAGS)
         temp_boolean = ~df[self.TEMP_QF_PAR].isin(EXCLUDE_QUALITY_FLAGS)
-        boolean = salt_boolean & temp_boolean
-        return df[boolean]
-
-    @cache
-    def _get_data_at_depth(self,
-                          depth: float,
-                          max_depth_diff_allowed: float = None,
-                          surface_layer_depth: float = None,
-                          bottom_layer_depth: float = None,
-                          ) -> pd.DataFrame:
-        df = self.data.copy(deep=True)
-        bottom_layer_top = None
-        if bottom_layer_depth:
-            bottom_layer_top = df['depth'].values[-1] - bottom_layer_depth
-        if surface_layer_depth and depth <= surface_layer_depth:
-            df = self.data[self.data['depth'] <= surface_layer_depth].reset_index()
-            max_depth_diff_allowed = None
-        elif bottom_layer_top and depth >= bottom_layer_top:
-            df = self.data[self.data['depth'] >= bottom_layer_depth].reset_index()
-            max_depth_diff_allowed = None
-        if df.empty:
-            return pd.DataFrame()
-        diff = abs(df['depth'] - depth)
-        min_diff = min(diff)
-        if max_depth_diff_allowed and min_diff > max_depth_diff_allowed:
-            return pd.DataFrame()
-        return df[diff == min_diff]
+        boolean = (salt_boolean & temp_boolean).values
+        profile = CtdProfile.from_arrays(df[self.DEPTH_PAR].values.astype(float)[boolean],
+                                         df[self.SALT_PAR].values.astype(float)[boolean],
+                                         df[self.TEMP_PAR].values.astype(float)[boolean],
+                                         dtype=self.dtype,
+                                         station=metadata.get('STATN'),
+                                         date=self.date,
+                                         ship=self.ship,
+                                         serno=self.serno)
+        return metadata, profile
+
+    @property
+    def is_loaded(self) -> bool:
+        """True if the file has been parsed and is held in memory"""
+        return '_content' in self.__dict__
+
+    def get_memory_usage(self) -> int:
+        """Bytes held by the parsed file, 0 if not loaded"""
+        if not self.is_loaded:
+            return 0
+        return self.profile.nbytes
 
-    @cache
-    def _get_data_at_deepest_depth(self):
-        max_depth = max(self.data['depth'])
-        return self.data[self.data['depth'] == max_depth]
+    def unload(self) -> None:
+        """Releases the parsed file. It is parsed again when needed."""
+        self.__dict__.pop('_content', None)
 
     def get_last_data_at_depth(self,
                                         depth: int | float | str,
@@ -119,31 +298,18 @@ class CtdStandardFormat:
                                         surface_layer_depth: float = None,
                                         bottom_layer_depth: float = None) -> (float, float, float):
         # depth can also be "deepest"
+        profile = self.profile
         if depth == 'deepest':
-            df = self._get_data_at_deepest_depth()
+            position = profile.get_position_at_deepest_depth()
         else:
-            df = self._get_data_at_depth(depth,
-                                        max_depth_diff_allowed=max_depth_diff_allowed,
-                                        surface_layer_depth=surface_layer_depth,
-                                        bottom_layer_depth=bottom_layer_depth,
-                                        )
-        if df.empty:
+            position = profile.get_position_at_depth(float(depth),
+                                                     max_depth_diff_allowed=max_depth_diff_allowed,
+                                                     surface_layer_depth=surface_layer_depth,
+                                                     bottom_layer_depth=bottom_layer_depth,
+                                                     )
+        if position is None:
             return {}
-        data = {}
-        data['salt'] = float(df[self.SALT_PAR].iloc[0])
-        # if df[self.SALT_QF_PAR].iloc[0] in EXCLUDE_QUALITY_FLAGS:
-        #     salt = np.nan
-        data['temp'] = float(df[self.TEMP_PAR].iloc[0])
-        # if df[self.TEMP_QF_PAR].iloc[0] in EXCLUDE_QUALITY_FLAGS:
-        #     temp = np.nan
-        data['depth'] = float(df[self.DEPTH_PAR].iloc[0])
-        
-        data['station'] = self.station
-        # if df[self.DEPTH_QF_PAR].iloc[0] in EXCLUDE_QUALITY_FLAGS:
-        #     depth = np.nan
-        # print('salt, temp, depth', salt, temp, depth)
-        return data
-        # return float(df[self.SALT_PAR].iloc[0]), float(df[self.TEMP_PAR].iloc[0]), float(df[self.DEPTH_PAR].iloc[0])
+        return profile.get_data_at_position(position)
 
 
 class CtdStandardFormatCollection:
@@ -153,19 +319,32 @@ class CtdStandardFormatCollection:
                  max_depth_diff_allowed: float = None,
                  surface_layer_depth: float = None,
                  bottom_layer_depth: float = None,
+                 query_cache_max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+                 query_cache_max_size: int = QUERY_CACHE_MAX_SIZE,
+                 profile_memory_budget: int = PROFILE_MEMORY_BUDGET,
+                 profile_dtype: type = np.float64,
                  ):
 
         self.directory = pathlib.Path(directory)
         self._max_depth_diff_allowed = max_depth_diff_allowed
         self._surface_layer_depth = surface_layer_depth
         self._bottom_layer_depth = bottom_layer_depth
+        self.query_cache = cache.MemoryLRUCache(max_entries=query_cache_max_entries, max_size=query_cache_max_size,
+                                                get_size=_get_query_size)
+        self.profile_memory_budget = profile_memory_budget
+        self.profile_dtype = profile_dtype
+        self.resident_size = 0
+        self._resident: collections.OrderedDict[str, int] = collections.OrderedDict()
         self._files = {}
         self._register_files()
 
     def _register_files(self):
         self._files = {}
+        self.query_cache.clear()
+        self._resident.clear()
+        self.resident_size = 0
         for path in self.directory.iterdir():
-            obj = CtdStandardFormat(path)
+            obj = CtdStandardFormat(path, dtype=self.profile_dtype)
             self._files[obj.key] = obj
 
     def _get_file(self, **kwargs) -> CtdStandardFormat:
@@ -176,6 +355,46 @@ class CtdStandardFormatCollection:
     def files(self):
         return self._files
 
+    def _set_resident(self, file: CtdStandardFormat) -> None:
+        """Marks file as the most recently used parsed profile. The least recently used profiles are unloaded
+        when the resident size exceeds profile_memory_budget."""
+        if file.key in self._resident:
+            self._resident.move_to_end(file.key)
+            return
+        if not file.is_loaded:
+            return
+        size = file.get_memory_usage()
+        self._resident[file.key] = size
+        self.resident_size += size
+        if not self.profile_memory_budget:
+            return
+        for key in list(self._resident):
+            if self.resident_size <= self.profile_memory_budget:
+                break
+            if key == file.key:
+                continue
+            self.resident_size -= self._resident.pop(key)
+            self._files[key].unload()
+
+    def get_fingerprint(self) -> str:
+        """Changes if the settings or any of the registered files change"""
+        parts = [self._max_depth_diff_allowed, self._surface_layer_depth, self._bottom_layer_depth]
+        for key in sorted(self._files):
+            stat = self._files[key].path.stat()
+            parts.append((self._files[key].path.name, stat.st_size, stat.st_mtime_ns))
+        return hashlib.sha1(str(parts).encode()).hexdigest()
+
+    def get_file_fingerprint(self, year: str | int = None, ship: str | int = None, serno: str | int = None) -> str | None:
+        """Changes if the settings or the ctd file for the given year, ship and serno change.
+        None if there is no such file."""
+        file = self._get_file(year=year, ship=ship, serno=serno)
+        if not file:
+            return None
+        stat = file.path.stat()
+        parts = [self._max_depth_diff_allowed, self._surface_layer_depth, self._bottom_layer_depth,
+                 file.path.name, stat.st_size, stat.st_mtime_ns]
+        return hashlib.sha1(str(parts).encode()).hexdigest()
+
     def filter_data_by_date(self, start_date: datetime.date = None, end_date: datetime.date = None):
         files = []
         for file in self.files:
@@ -185,6 +404,7 @@ class CtdStandardFormatCollection:
                 continue
             files.append(file)
         self._files = files
+        self.query_cache.clear()
 
     def get_ctd_data(self,
                      year: str | int = None,
@@ -195,11 +415,24 @@ class CtdStandardFormatCollection:
         file = self._get_file(year=year, ship=ship, serno=serno)
         if not file:
             return {}
-        return file.get_last_data_at_depth(depth,
-                                            max_depth_diff_allowed=self._max_depth_diff_allowed,
-                                            surface_layer_depth=self._surface_layer_depth,
-                                            bottom_layer_depth=self._bottom_layer_depth,
-                                            )
+        if isinstance(depth, float) and np.isnan(depth):
+            # No data at a missing depth. Not cached since nan keys never compare equal.
+            return {}
+        cache_key = (file.key, depth)
+        record = self.query_cache.get(cache_key)
+        if record is None and cache_key not in self.query_cache:
+            data = file.get_last_data_at_depth(depth,
+                                               max_depth_diff_allowed=self._max_depth_diff_allowed,
+                                               surface_layer_depth=self._surface_layer_depth,
+                                               bottom_layer_depth=self._bottom_layer_depth,
+                                               )
+            self._set_resident(file)
+            if data:
+                record = (data['salt'], data['temp'], data['depth'], data['station'])
+            self.query_cache.put(cache_key, record)
+        if record is None:
+            return {}
+        return dict(zip(['salt', 'temp', 'depth', 'station'], record))
 
 
 if __name__ == '__main__':
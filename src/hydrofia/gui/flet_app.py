@@ -512,7 +512,7 @@ class FletApp:
             label='År',
             hint_text='Filtrera på år',
             options=year_options,
-            on_change=self._update_create_template_path,
+            on_change=self._on_change_year,
             dense=True
         )
         self._year.value = str(datetime.datetime.now().year)
@@ -748,11 +748,51 @@ class FletApp:
     def _set_hydrofia_file_path(self, text=None):
         if not text:
             return
-        # TODO: Validate file
         self._hydrofia_file_path.value = text
+        if self._update_year_and_month_options():
+            self._update_create_template_path()
+        else:
+            self.create_template_path = None
+        self.update_page()
+
+    def _on_change_year(self, *args):
+        self._update_month_options()
         self._update_create_template_path()
         self.update_page()
 
+    def _update_year_and_month_options(self) -> bool:
+        """Sets the years and months found in the hydrofia export file as options.
+        Returns False if the file could not be read."""
+        if not self.hydrofia_file_path or not self.hydrofia_file_path.exists():
+            return True
+        try:
+            years = [str(y) for y in hydrofia.get_years_in_hydrofia_export_file(self.hydrofia_file_path)]
+        except Exception as e:
+            self._show_info(TEXTS.invalid_hydrofia_file(self.hydrofia_file_path, e))
+            return False
+        if not years:
+            return True
+        self._year.options = [ft.dropdown.Option(y) for y in years]
+        if self._year.value not in years:
+            self._year.value = years[-1]
+        self._update_month_options()
+        return True
+
+    def _update_month_options(self):
+        """Sets the months of the selected year found in the hydrofia export file as month options"""
+        if not self.hydrofia_file_path or not self.hydrofia_file_path.exists() or not self._year.value:
+            return
+        try:
+            months = [str(m) for m in hydrofia.get_months_in_hydrofia_export_file(self.hydrofia_file_path,
+                                                                                  year=int(self._year.value))]
+        except Exception as e:
+            self._show_info(TEXTS.invalid_hydrofia_file(self.hydrofia_file_path, e))
+            return
+        self._month.options = [ft.dropdown.Option(self._month_all_option)] + \
+                              [ft.dropdown.Option(m) for m in months]
+        if self._month.value not in months:
+            self._month.value = self._month_all_option
+
     def _on_pick_ctd_dir(self, e: ft.FilePickerResultEvent):
         self._close_banner()
         if not e.path:
@@ -990,7 +1030,12 @@ class FletApp:
                 month = None
             else:
                 month = int(month)
-            id_string = hydrofia.get_id_string_for_hydrofia_export_file(self.hydrofia_file_path, year=year, month=month)
+            try:
+                id_string = hydrofia.get_id_string_for_hydrofia_export_file(self.hydrofia_file_path, year=year,
+                                                                            month=month)
+            except Exception as e:
+                self._show_info(TEXTS.invalid_hydrofia_file(self.hydrofia_file_path, e))
+                id_string = None
             if not id_string:
                 self.create_template_path = None
                 return
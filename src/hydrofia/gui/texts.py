@@ -117,6 +117,9 @@ class Texts:
     def get_info_creating_result_done(self, path):
         return f'Resultatfil har skapats: {path}'
 
+    def invalid_hydrofia_file(self, path, error):
+        return f'Kunde inte läsa HydroFIA-filen {path}:\n{error}'
+
     @property
     def template_export_file_name(self):
         return 'Ange namn på din Hydro FIA excelfil som ska skapas'
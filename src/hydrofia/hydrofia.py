@@ -1,86 +1,349 @@
+import abc
 import csv
 import datetime
+import functools
+import hashlib
+import io
+import json
+import logging
 import pathlib
+import posixpath
 import re
 import sys
-from typing import Protocol
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Protocol
 
 import numpy as np
 import pandas as pd
-from openpyxl import Workbook
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import PatternFill, Border, Side, numbers, Alignment
-from openpyxl.utils import get_column_letter
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel, from_ISO8601
+from openpyxl.worksheet.cell_range import CellRange
 
+from hydrofia import cache
 from hydrofia import utils
 
 # if typing.TYPE_CHECKING:
 #     from hydrofia.calculate import HydrofiaData
 
+logger = logging.getLogger(__name__)
+
 if getattr(sys, 'frozen', False):
     DIRECTORY = pathlib.Path(sys.executable).parent
 else:
     DIRECTORY = pathlib.Path(__file__).parent
 
 
-class HydrofiaExportFileDiscrete:
-
-    SAMPLE_NAME_PATTERNS = [
-        re.compile('^{}{}{}-{}{}{}$'.format(
-            r'(?P<year>\d{4})',
-            r'(?P<country>\d{2})',
-            r'(?P<ship>\d{2})',
-            r'(?P<serno>\d{4})',
-            r'(?P<sep>[-_])',
-            # r'(?P<depth>\d*)'
-            r'(?P<depth>[0-9/]*)'
-        )),
-        re.compile('^{}{}{}-{}{}{}$'.format(
-            r'(?P<year>\d{2})',
-            r'(?P<country>\d{2})',
-            r'(?P<ship>\d{2})',
-            r'(?P<serno>\d{4})',
-            r'(?P<sep>[-_])',
-            # r'(?P<depth>\d*)'
-            r'(?P<depth>[0-9/]*)'
-        )),
-        re.compile('^{}{}{}-{}{}{}$'.format(
-            r'(?P<year>\d{4})',
-            r'(?P<country>\d{2})',
-            r'(?P<ship>\d{2})',
-            r'(?P<serno>\d{4})',
-            r'(?P<sep>[-_])',
-            r'(?P<depth>[xX])'
-        )),
-        re.compile('^{}{}{}-{}{}{}$'.format(
-            r'(?P<year>\d{2})',
-            r'(?P<country>\d{2})',
-            r'(?P<ship>\d{2})',
-            r'(?P<serno>\d{4})',
-            r'(?P<sep>[-_])',
-            r'(?P<depth>[xX])'
-        )),
-        re.compile('^.*CRM.*$'),
-        re.compile('^{}{}{}-{}{}{}$'.format(
-            r'(?P<year>\d{2})',
-            r'(?P<country>\d{2})',
-            r'(?P<ship>\d{2})',
-            r'(?P<serno>\d{4})',
-            r'(?P<sep>[-_])',
-            r'(?P<depth>DIB)'
-        )),
-    ]
+def get_info(sernos: pd.Series, years: pd.Series) -> dict:
+    """Returns the years, the serno range and the CRM names among the given sernos"""
+    sorted_sernos = sorted(set(sernos))
+    crms = [serno for serno in sorted_sernos if 'CRM' in serno]
+    sorted_sernos = [serno for serno in sorted_sernos if 'CRM' not in serno]
+    years = sorted(pd.unique(years).tolist())
+    if not sorted_sernos:
+        return {}
+    from_serno = sorted_sernos[0]
+    to_serno = sorted_sernos[-1]
+    info = dict(
+        years=years,
+        year_string='-'.join([str(y) for y in years]),
+        from_serno=from_serno,
+        to_serno=to_serno,
+        crms=crms
+    )
+    return info
+
+
+def get_date_slice(dates: pd.Series, start_date: datetime.date = None, end_date: datetime.date = None) -> slice:
+    """Returns the positions of dates (sorted) between start_date and end_date (inclusive)"""
+    values = dates.values
+    start = 0
+    end = len(values)
+    if start_date:
+        start = np.searchsorted(values, np.datetime64(pd.Timestamp(start_date)), side='left')
+    if end_date:
+        end = np.searchsorted(values, np.datetime64(pd.Timestamp(end_date)), side='right')
+    return slice(start, max(start, end))
+
+
+class _BoundedReader(io.RawIOBase):
+    """Reads from a binary file object up to the byte position end"""
+
+    def __init__(self, fid: io.BufferedReader, end: int) -> None:
+        self._fid = fid
+        self._end = end
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._end - self._fid.tell())
+        if size <= 0:
+            return 0
+        data = self._fid.read(size)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class _XlsxSheetReader:
+    """Streams the cell values of the first sheet in a xlsx file. Much faster than openpyxl for large
+    sheets since no cell objects are created. Only used for reading, formulas give their cached values."""
+    NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+    REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+    PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
 
     def __init__(self, path: str | pathlib.Path) -> None:
         self.path = pathlib.Path(path)
 
+    def get_sheet_names(self) -> list[str]:
+        with zipfile.ZipFile(self.path) as archive:
+            _, workbook = self._get_workbook(archive)
+        return [sheet.get('name') for sheet in workbook.iter(f'{self.NS}sheet')]
+
+    def get_first_row(self, min_row: int = 1, sheet_name: str = None) -> dict[int, object]:
+        rows = self.iter_rows(min_row=min_row, sheet_name=sheet_name)
+        row = next(rows, {})
+        rows.close()
+        return row
+
+    def iter_rows(self, min_row: int = 1, columns: set[int] = None,
+                  sheet_name: str = None) -> Iterator[dict[int, object]]:
+        """Yields the non-empty cells of each row from min_row as a dict with zero based column index as key.
+        Only the given columns are read if columns is given. Rows without cells are not yielded.
+        The first sheet is read if sheet_name is not given."""
+        for _, cells in self.iter_numbered_rows(min_row=min_row, columns=columns, sheet_name=sheet_name):
+            yield cells
+
+    def iter_numbered_rows(self, min_row: int = 1, columns: set[int] = None,
+                           sheet_name: str = None) -> Iterator[tuple[int, dict[int, object]]]:
+        """As iter_rows but yields the (one based) row number together with the cells"""
+        with zipfile.ZipFile(self.path) as archive:
+            workbook_path, workbook = self._get_workbook(archive)
+            epoch = CALENDAR_WINDOWS_1900
+            workbook_pr = workbook.find(f'{self.NS}workbookPr')
+            if workbook_pr is not None and workbook_pr.get('date1904') in ['1', 'true']:
+                epoch = CALENDAR_MAC_1904
+            sheets = workbook.findall(f'{self.NS}sheets/{self.NS}sheet')
+            if sheet_name is not None:
+                sheets = [sheet for sheet in sheets if sheet.get('name') == sheet_name]
+            if not sheets:
+                raise KeyError(f'No sheet named {sheet_name} in {self.path}')
+            rels_path = posixpath.join(posixpath.dirname(workbook_path), '_rels',
+                                       f'{posixpath.basename(workbook_path)}.rels')
+            relationships = self._get_relationships(archive, rels_path)
+            sheet_path = self._get_target(relationships, rel_id=sheets[0].get(f'{self.REL_NS}id'))
+            if sheet_path is None:
+                raise KeyError(f'No relationship for sheet {sheets[0].get("name")} in {rels_path} of {self.path}')
+            shared_strings_path = self._get_target(relationships, rel_type='sharedStrings')
+            shared_strings = self._get_shared_strings(archive, shared_strings_path)
+            date_styles = self._get_date_styles(archive, self._get_target(relationships, rel_type='styles'))
+            with archive.open(sheet_path) as fid:
+                row_tag = f'{self.NS}row'
+                row_number = 0
+                for _, element in ET.iterparse(fid):
+                    if element.tag != row_tag:
+                        continue
+                    row_number = int(element.get('r', row_number + 1))
+                    if row_number >= min_row:
+                        cells = self._get_row_values(element, columns, shared_strings, date_styles, epoch)
+                        if cells:
+                            yield row_number, cells
+                    element.clear()
+
+    def _get_row_values(self, row: ET.Element, columns: set[int] | None, shared_strings: list[str],
+                        date_styles: set[int], epoch: datetime.datetime) -> dict[int, object]:
+        cells = {}
+        col = -1
+        for cell in row.iter(f'{self.NS}c'):
+            ref = cell.get('r')
+            if ref:
+                col = column_index_from_string(ref.rstrip('0123456789')) - 1
+            else:
+                col += 1
+            if columns is not None and col not in columns:
+                continue
+            data_type = cell.get('t', 'n')
+            if data_type == 'inlineStr':
+                value = ''.join(text.text or '' for text in cell.iter(f'{self.NS}t'))
+            else:
+                value = cell.findtext(f'{self.NS}v')
+                if value is None:
+                    continue
+                if data_type == 'n':
+                    value = float(value) if any(c in value for c in '.eE') else int(value)
+                    if int(cell.get('s', 0)) in date_styles:
+                        value = from_excel(value, epoch)
+                elif data_type == 's':
+                    value = shared_strings[int(value)]
+                elif data_type == 'b':
+                    value = bool(int(value))
+                elif data_type == 'd':
+                    value = from_ISO8601(value)
+            cells[col] = value
+        return cells
+
+    def _get_workbook(self, archive: zipfile.ZipFile) -> tuple[str, ET.Element]:
+        workbook_path = self._get_target(self._get_relationships(archive, '_rels/.rels'), rel_type='officeDocument')
+        if workbook_path is None:
+            raise KeyError(f'No workbook in {self.path}')
+        return workbook_path, ET.fromstring(archive.read(workbook_path))
+
+    def _get_relationships(self, archive: zipfile.ZipFile, rels_path: str) -> list[tuple[str, str, str]]:
+        """Returns (id, type, archive path of the target) of the relationships in rels_path. The type is the last
+        part of the type uri, e.g. officeDocument or sharedStrings."""
+        relationships = []
+        for rel in ET.fromstring(archive.read(rels_path)).iter(f'{self.PACKAGE_REL_NS}Relationship'):
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join(posixpath.dirname(posixpath.dirname(rels_path)), target))
+            relationships.append((rel.get('Id'), rel.get('Type').rsplit('/', 1)[-1], target))
+        return relationships
+
+    @staticmethod
+    def _get_target(relationships: list[tuple[str, str, str]], rel_id: str = None, rel_type: str = None) -> str | None:
+        """Returns the target of the relationship with rel_id, or of the first relationship of rel_type"""
+        for _id, _type, target in relationships:
+            if _id == rel_id or (rel_id is None and _type == rel_type):
+                return target
+        return None
+
+    def _get_shared_strings(self, archive: zipfile.ZipFile, path: str | None) -> list[str]:
+        if path is None:
+            return []
+        strings = []
+        with archive.open(path) as fid:
+            for _, element in ET.iterparse(fid):
+                if element.tag != f'{self.NS}si':
+                    continue
+                # Phonetic runs (rPh) are not part of the value
+                parts = [element.findtext(f'{self.NS}t') or '']
+                parts.extend(run.findtext(f'{self.NS}t') or '' for run in element.iter(f'{self.NS}r'))
+                strings.append(''.join(parts))
+                element.clear()
+        return strings
+
+    def _get_date_styles(self, archive: zipfile.ZipFile, path: str | None) -> set[int]:
+        """Returns the index of the cell styles with a date number format"""
+        if path is None:
+            return set()
+        styles = ET.fromstring(archive.read(path))
+        formats = dict(BUILTIN_FORMATS)
+        for fmt in styles.iter(f'{self.NS}numFmt'):
+            formats[int(fmt.get('numFmtId'))] = fmt.get('formatCode')
+        cell_xfs = styles.find(f'{self.NS}cellXfs')
+        if cell_xfs is None:
+            return set()
+        date_styles = set()
+        for i, xf in enumerate(cell_xfs.iter(f'{self.NS}xf')):
+            if is_date_format(formats.get(int(xf.get('numFmtId', 0)), '')):
+                date_styles.add(i)
+        return date_styles
+
+
+class _HydrofiaExportData:
+    """Access to parsed export data kept sorted by date in self._data. data is limited to the dates
+    in self._date_window, see filter_data_by_date."""
+    _data: pd.DataFrame | None = None
+    _date_window: tuple[datetime.date | None, datetime.date | None] = (None, None)
+
+    def __getitem__(self, item: str) -> str:
+        return self.data[item]
+
+    @property
+    def data(self) -> pd.DataFrame:
+        return self.get_data_by_date(*self._date_window)
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self.data.columns)
+
+    def get_info(self) -> dict:
+        return get_info(sernos=self.data['serno'], years=self.data['year'])
+
+    def get_data(self) -> pd.DataFrame:
+        return self.data
+
+    def filter_data_by_date(self, start_date: datetime.date = None, end_date: datetime.date = None) -> None:
+        """Limits data to the given dates. The loaded data is kept so the limits can be changed at any time."""
+        self._date_window = (start_date, end_date)
+
+    def get_data_by_date(self, start_date: datetime.date = None, end_date: datetime.date = None) -> pd.DataFrame:
+        return self._data.iloc[get_date_slice(self._data['date'], start_date, end_date)]
+
+
+class HydrofiaExportFileDiscrete(_HydrofiaExportData):
+
+    # All accepted sample name conventions in one alternation, used both to validate and to split the names.
+    # CRM names keep the whole name as serno. Add new conventions as alternatives here.
+    SAMPLE_NAME_PATTERN = re.compile('^(?:{}{}{}-{}{}{}|{})$'.format(
+        r'(?P<year>\d{4}|\d{2})',
+        r'(?P<country>\d{2})',
+        r'(?P<ship>\d{2})',
+        r'(?P<serno>\d{4})',
+        r'(?P<sep>[-_])',
+        r'(?P<depth>[0-9/]*|X|(?<=^\d{6}-\d{4}[-_])DIB)',  # DIB only with two digit year
+        r'(?P<crm>.*CRM.*)',
+    ), re.IGNORECASE)
+
+    TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+    # Columns in the header (second line) of every export file
+    REQUIRED_COLUMNS = ['timestamp', 'action', 'sampleName']
+
+    # Column types. Columns not listed here are kept as strings.
+    FLOAT_COLUMNS = ['absorbance578', 'absorbance434', 'temperatureSample', 'salinity']
+    CATEGORY_COLUMNS = ['action', 'sampleName', 'country', 'ship']
+
+    # Number of lines read from the export file at a time
+    CHUNK_SIZE = 10_000
+
+    # Increase when the content of the parsed data changes so that old cache entries are not used
+    CACHE_VERSION = 5
+
+    # Number of bytes from the start and the end of the parsed part of the file used to check that it is unchanged
+    PREFIX_SAMPLE_SIZE = 64 * 1024
+
+    def __init__(self,
+                 path: str | pathlib.Path,
+                 start_date: datetime.date = None,
+                 end_date: datetime.date = None,
+                 use_cache: bool = True,
+                 float_dtype: str = 'float64') -> None:
+        """Only discrete measurements between start_date and end_date (inclusive) are kept when reading the file.
+        Columns in FLOAT_COLUMNS are given float_dtype ('float64' or 'float32') and columns in CATEGORY_COLUMNS
+        are stored as categories.
+        The parsed data is cached on disk (see hydrofia.cache) unless use_cache is False.
+        Since the export file only grows, lines appended after the file (or the cache) was last parsed
+        are parsed and added to the data without reading the whole file again, see update()."""
+        self.path = pathlib.Path(path)
+        self._start_date = start_date
+        self._end_date = end_date
+        self._float_dtype = float_dtype
+        self._cache = cache.get_export_file_cache() if use_cache else None
+
         self._header_original: list[str] | None = None
         self._units_original: list[str] | None = None
         self._data: pd.DataFrame | None = None
+        self._sample_name_parts: pd.DataFrame | None = None
+        self._date_window: tuple[datetime.date | None, datetime.date | None] = (None, None)
 
-        self._load_file()
-        self._filter_data()
-        self._add_columns()
-        self._reorder_columns()
+        self._fingerprint: dict | None = None
+        self._parsed_offset: int | None = None
+        self._parsed_rows = 0
+        self._prefix_hash: str | None = None
+
+        if self._load_from_cache():
+            self.update()
+        else:
+            self._parse(self._get_fingerprint())
 
     def __str__(self) -> str:
         return '\n'.join([
@@ -90,114 +353,190 @@ class HydrofiaExportFileDiscrete:
             f'  End time     : {max(self.data["timestamp"])}',
         ])
 
-    def __getitem__(self, item: str) -> str:
-        return self.data[item]
+    @classmethod
+    def is_export_file(cls, path: str | pathlib.Path) -> bool:
+        """True if the header of the file has the REQUIRED_COLUMNS"""
+        try:
+            with open(path) as fid:
+                fid.readline()
+                header = next(csv.reader([fid.readline()]), [])
+        except (OSError, UnicodeDecodeError, csv.Error):
+            return False
+        return all(col in header for col in cls.REQUIRED_COLUMNS)
+
+    def update(self) -> None:
+        """Parses lines appended to the file since it was last parsed. The whole file is parsed again
+        if the previously parsed part of the file has changed."""
+        fingerprint = self._get_fingerprint()
+        if fingerprint == self._fingerprint:
+            return
+        if self._is_parsed_part_unchanged(fingerprint):
+            self._parse(fingerprint, previous_data=self._data)
+        else:
+            self._parse(fingerprint)
 
     @property
-    def data(self) -> pd.DataFrame:
-        return self._data
+    def _cache_key(self) -> str:
+        return cache.get_key(self.path.resolve(), self._start_date, self._end_date, self._float_dtype)
 
-    @property
-    def columns(self) -> list[str]:
-        return list(self.data.columns)
+    def _get_fingerprint(self) -> dict:
+        stat = self.path.stat()
+        return dict(version=self.CACHE_VERSION, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
 
-    def get_info(self) -> dict:
-        sorted_sernos = sorted(set(self._data['serno']))
-        crms = [serno for serno in sorted_sernos if 'CRM' in serno]
-        sorted_sernos = [serno for serno in sorted_sernos if 'CRM' not in serno]
-        years = sorted(set(self._data['year']))
-        if not sorted_sernos:
-            return {}
-        from_serno = sorted_sernos[0]
-        to_serno = sorted_sernos[-1]
-        info = dict(
-            years=years,
-            year_string='-'.join([str(y) for y in years]),
-            from_serno=from_serno,
-            to_serno=to_serno,
-            crms=crms
+    def _load_from_cache(self) -> bool:
+        if not self._cache:
+            return False
+        meta = self._cache.get_meta(self._cache_key)
+        if not meta or meta['fingerprint']['version'] != self.CACHE_VERSION:
+            return False
+        data = self._cache.get_data(self._cache_key)
+        if data is None:
+            return False
+        self._header_original = meta['header']
+        self._units_original = meta['units']
+        self._fingerprint = meta['fingerprint']
+        self._parsed_offset = meta['parsed_offset']
+        self._parsed_rows = meta['parsed_rows']
+        self._prefix_hash = meta['prefix_hash']
+        self._data = data
+        return True
+
+    def _save_to_cache(self) -> None:
+        if not self._cache:
+            return
+        meta = dict(
+            path=str(self.path.resolve()),
+            fingerprint=self._fingerprint,
+            header=self._header_original,
+            units=self._units_original,
+            parsed_offset=self._parsed_offset,
+            parsed_rows=self._parsed_rows,
+            prefix_hash=self._prefix_hash,
         )
-        return info
-
-    def get_data(self) -> pd.DataFrame:
-        return self.data
+        self._cache.put(self._cache_key, self._data, meta)
+
+    def _get_prefix_hash(self, fid: io.BufferedReader, offset: int) -> str:
+        """Hash of the start and the end of the first offset bytes of the file"""
+        sample_size = min(self.PREFIX_SAMPLE_SIZE, offset)
+        fid.seek(0)
+        head = fid.read(sample_size)
+        fid.seek(offset - sample_size)
+        tail = fid.read(sample_size)
+        return hashlib.sha1(b'|'.join([str(offset).encode(), head, tail])).hexdigest()
+
+    def _is_parsed_part_unchanged(self, fingerprint: dict) -> bool:
+        if self._parsed_offset is None or fingerprint['size'] < self._parsed_offset:
+            return False
+        with open(self.path, 'rb') as fid:
+            return self._get_prefix_hash(fid, self._parsed_offset) == self._prefix_hash
 
-    def filter_data_by_date(self, start_date: datetime.date = None, end_date: datetime.date = None) -> None:
-        filter_boolean = np.full(len(self.data), True)
-        if start_date:
-            filter_boolean = filter_boolean & (self.data['date'] >= start_date)
-        if end_date:
-            filter_boolean = filter_boolean & (self.data['date'] <= end_date)
-        self._data = self._data[filter_boolean]
+    @staticmethod
+    def _get_end_of_last_line(fid: io.BufferedReader) -> int:
+        """Returns the byte position after the last complete line. A line still being written is left out."""
+        end = fid.seek(0, io.SEEK_END)
+        while end > 0:
+            start = max(0, end - io.DEFAULT_BUFFER_SIZE)
+            fid.seek(start)
+            pos = fid.read(end - start).rfind(b'\n')
+            if pos != -1:
+                return start + pos + 1
+            end = start
+        return 0
+
+    def _parse(self, fingerprint: dict, previous_data: pd.DataFrame = None) -> None:
+        """Parses the file from the start or, if previous_data is given, from where it was last parsed"""
+        if previous_data is None:
+            self._parsed_offset = None
+            self._parsed_rows = 0
+        self._load_file()
+        self._filter_data()
+        self._add_columns()
+        self._reorder_columns()
+        if previous_data is not None and not previous_data.empty:
+            if self._data.empty:
+                self._data = previous_data
+            else:
+                self._data = pd.concat([previous_data, self._data])
+        self._set_category_columns()
+        self._sort_data()
+        self._fingerprint = fingerprint
+        self._save_to_cache()
 
     def _load_file(self) -> None:
-        row_data = []
-        with open(self.path) as fid:
-            file_data = csv.reader(fid)
-            for r, row in enumerate(file_data):
-                if r == 0:
-                    continue
-                elif r == 1:
-                    self._header_original = row
-                elif r == 2:
-                    self._units_original = row
-                else:
-                    row_data.append(row)
-        self._data = pd.DataFrame(row_data, columns=self._header_original)
+        with open(self.path, 'rb') as fid:
+            end = self._get_end_of_last_line(fid)
+            fid.seek(self._parsed_offset or 0)
+            # Encoding as for open() in text mode
+            text_fid = io.TextIOWrapper(io.BufferedReader(_BoundedReader(fid, end)))
+            if self._parsed_offset is None:
+                text_fid.readline()
+                self._header_original = next(csv.reader([text_fid.readline()]), [])
+                if not all(col in self._header_original for col in self.REQUIRED_COLUMNS):
+                    raise ValueError(f'Not a hydrofia export file, the header has no '
+                                     f'{", ".join(self.REQUIRED_COLUMNS)} columns: {self.path}')
+                self._units_original = next(csv.reader([text_fid.readline()]))
+            chunks = pd.read_csv(text_fid,
+                                 header=None,
+                                 names=self._header_original,
+                                 dtype=str,
+                                 keep_default_na=False,
+                                 chunksize=self.CHUNK_SIZE)
+            row_data = []
+            start_row = self._parsed_rows
+            for chunk in chunks:
+                # Index is the line number among all data lines in the file
+                chunk.index += start_row
+                self._parsed_rows += len(chunk)
+                row_data.append(self._set_float_columns(self._filter_chunk(chunk)))
+            self._parsed_offset = end
+            self._prefix_hash = self._get_prefix_hash(fid, end)
+        if not row_data:
+            self._data = self._set_float_columns(pd.DataFrame(columns=self._header_original, dtype=str))
+            return
+        self._data = pd.concat(row_data)
+
+    def _filter_chunk(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        boolean = chunk['action'] == 'Measure discrete'
+        # Timestamps are in ISO format so the date part can be compared as strings
+        if self._start_date:
+            boolean = boolean & (chunk['timestamp'].str[:10] >= self._start_date.strftime('%Y-%m-%d'))
+        if self._end_date:
+            boolean = boolean & (chunk['timestamp'].str[:10] <= self._end_date.strftime('%Y-%m-%d'))
+        return chunk[boolean]
+
+    def _set_float_columns(self, data: pd.DataFrame) -> pd.DataFrame:
+        data = data.copy()
+        for col in self.FLOAT_COLUMNS:
+            if col in data:
+                data[col] = pd.to_numeric(data[col], errors='coerce').astype(self._float_dtype)
+        return data
+
+    def _sort_data(self) -> None:
+        """Data is kept sorted on time so that dates can be looked up with binary search"""
+        if not self._data['timestamp'].is_monotonic_increasing:
+            self._data = self._data.sort_values('timestamp', kind='stable')
+
+    def _set_category_columns(self) -> None:
+        for col in self.CATEGORY_COLUMNS:
+            if col in self._data:
+                self._data[col] = self._data[col].astype('category')
 
     def _add_columns(self):
-
-        def extract_country(sampname: str):
-            if 'CRM' in sampname:
-                return ''
-            parts = sampname.split('-')
-            return utils.map_ship(parts[0][-4:-2])
-
-        def extract_ship(sampname: str):
-            if 'CRM' in sampname:
-                return ''
-            parts = sampname.split('-')
-            return utils.map_ship(parts[0][-2:])
-
-        def extract_serno(sampname) -> str:
-            if 'CRM' in sampname:
-                return sampname
-            parts = sampname.split('-')
-            if len(parts) == 3:
-                return parts[1]
-            return parts[1].split('_')[0]
-
-        def extract_depth(sampname):
-            if 'CRM' in sampname:
-                return ''
-            if not sampname:
-                return ''
-            if '_' in sampname:
-                return sampname.split('_')[-1]
-            return sampname.split('-')[-1]
-
-        def convert_timestamp(d):
-            return datetime.datetime.strptime(d, '%Y-%m-%dT%H:%M:%S')
-
-        self._data['timestamp'] = self._data['timestamp'].apply(convert_timestamp)
-        self._data['date'] = self._data['timestamp'].apply(lambda x: x.date())
-        self._data['year'] = self._data['date'].apply(lambda x: x.year)
-        self._data['country'] = self._data['sampleName'].apply(extract_country)
-        self._data['ship'] = self._data['sampleName'].apply(extract_ship)
-        self._data['serno'] = self._data['sampleName'].apply(extract_serno)
-        self._data['depth'] = self._data['sampleName'].apply(extract_depth)
-        self._data['Rspec'] = self._data['absorbance578'].apply(float) / self._data['absorbance434'].apply(float)
+        parts = self._sample_name_parts
+        self._data['timestamp'] = pd.to_datetime(self._data['timestamp'], format=self.TIMESTAMP_FORMAT)
+        self._data['date'] = self._data['timestamp'].dt.normalize()
+        self._data['year'] = self._data['timestamp'].dt.year.astype(int)
+        self._data['country'] = parts['country'].replace(utils.SHIP_MAPPER).fillna('')
+        self._data['ship'] = parts['ship'].replace(utils.SHIP_MAPPER).fillna('')
+        self._data['serno'] = parts['serno'].fillna(parts['crm'])
+        self._data['depth'] = parts['depth'].fillna('')
+        self._data['Rspec'] = self._data['absorbance578'] / self._data['absorbance434']
 
     def _filter_data(self):
-        def match_pattern(sampname):
-            sampname_upper = sampname.upper()
-            for pat in self.SAMPLE_NAME_PATTERNS:
-                if pat.match(sampname_upper):
-                    return True
-            return False
-        boolean = self._data['action'] == 'Measure discrete'
-        boolean = boolean * self._data['sampleName'].apply(match_pattern)
+        parts = self._data['sampleName'].str.extract(self.SAMPLE_NAME_PATTERN)
+        boolean = parts['serno'].notna() | parts['crm'].notna()
         self._data = self._data[boolean]
+        self._sample_name_parts = parts[boolean]
 
     def _reorder_columns(self):
         first_columns = ['country', 'ship', 'date', 'serno', 'depth']
@@ -205,6 +544,182 @@ class HydrofiaExportFileDiscrete:
         self._data = self._data[new_columns]
 
 
+class HydrofiaExportFileCollection(_HydrofiaExportData):
+    """Discrete data from several export files covering the same period, e.g. after an instrument restart.
+    Accepts a list of files or a directory. Files that are not export files (see
+    HydrofiaExportFileDiscrete.is_export_file), e.g. txt archives or templates in the same directory, are skipped.
+    The files are parsed in parallel and measurements found in more than one file (same timestamp and
+    sampleName) are only kept once."""
+
+    FILE_PATTERN = '*.txt'
+    DUPLICATE_KEY_COLUMNS = ['timestamp', 'sampleName']
+
+    def __init__(self,
+                 paths: list[str | pathlib.Path] | str | pathlib.Path,
+                 start_date: datetime.date = None,
+                 end_date: datetime.date = None,
+                 use_cache: bool = True,
+                 max_workers: int = None) -> None:
+        """Other arguments are passed on to HydrofiaExportFileDiscrete"""
+        if isinstance(paths, (str, pathlib.Path)):
+            paths = [paths]
+        self.paths = []
+        self.skipped_paths = []
+        for path in paths:
+            path = pathlib.Path(path)
+            for file_path in sorted(path.glob(self.FILE_PATTERN)) if path.is_dir() else [path]:
+                # Missing files are kept so that loading them fails with FileNotFoundError
+                if not file_path.exists() or HydrofiaExportFileDiscrete.is_export_file(file_path):
+                    self.paths.append(file_path)
+                else:
+                    logger.warning(f'Skipping {file_path}, not a hydrofia export file')
+                    self.skipped_paths.append(file_path)
+
+        self._start_date = start_date
+        self._end_date = end_date
+        self._use_cache = use_cache
+        self._max_workers = max_workers
+
+        self._files: list[HydrofiaExportFileDiscrete] = []
+        self._data: pd.DataFrame | None = None
+        self._date_window: tuple[datetime.date | None, datetime.date | None] = (None, None)
+
+        self._load_files()
+        self._combine_data()
+
+    def __str__(self) -> str:
+        return '\n'.join([
+            f'{self.__class__.__name__}: {len(self.paths)} files',
+            *[f'  {path}' for path in self.paths],
+            f'  Nr data lines: {len(self.data)}',
+        ])
+
+    @property
+    def files(self) -> list[HydrofiaExportFileDiscrete]:
+        return self._files
+
+    def _load_file(self, path: pathlib.Path) -> HydrofiaExportFileDiscrete:
+        return HydrofiaExportFileDiscrete(path,
+                                          start_date=self._start_date,
+                                          end_date=self._end_date,
+                                          use_cache=self._use_cache)
+
+    def _load_files(self) -> None:
+        if not self.paths and self.skipped_paths:
+            raise ValueError(f'No hydrofia export files given. Not export files (the header has no '
+                             f'{", ".join(HydrofiaExportFileDiscrete.REQUIRED_COLUMNS)} columns): '
+                             f'{", ".join(str(path) for path in self.skipped_paths)}')
+        if not self.paths:
+            raise FileNotFoundError('No hydrofia export files given')
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            self._files = list(executor.map(self._load_file, self.paths))
+
+    def _combine_data(self) -> None:
+        data = [file.get_data_by_date() for file in self._files]
+        data = [df for df in data if not df.empty]
+        if not data:
+            self._data = self._files[0].get_data_by_date()
+            return
+        data = pd.concat(data, ignore_index=True)
+        data = data.drop_duplicates(subset=self.DUPLICATE_KEY_COLUMNS)
+        data = data.sort_values('timestamp', kind='stable').reset_index(drop=True)
+        for col in HydrofiaExportFileDiscrete.CATEGORY_COLUMNS:
+            if col in data:
+                data[col] = data[col].astype('category')
+        self._data = data
+
+
+class HydrofiaExportFileSummary:
+    """Years, months and sernos of the discrete samples in an export file.
+    Only the timestamp, action and sampleName columns are read."""
+
+    COLUMNS = ['timestamp', 'action', 'sampleName']
+
+    def __init__(self, path: str | pathlib.Path) -> None:
+        self.path = pathlib.Path(path)
+        self._sernos: pd.DataFrame | None = None
+        self._load_file()
+
+    def __str__(self) -> str:
+        return '\n'.join([
+            f'{self.__class__.__name__}: {self.path}',
+            f'  Years: {self.years}',
+        ])
+
+    @property
+    def years(self) -> list[int]:
+        return sorted(self._sernos['year'].unique().tolist())
+
+    def get_months(self, year: int) -> list[int]:
+        return sorted(self._sernos.loc[self._sernos['year'] == year, 'month'].unique().tolist())
+
+    @property
+    def index(self) -> pd.DataFrame:
+        """One row per year and month with the serno range and CRM names"""
+        rows = []
+        for (year, month), df in self._sernos.groupby(['year', 'month']):
+            is_crm = df['serno'].str.contains('CRM')
+            sernos = df.loc[~is_crm, 'serno']
+            rows.append(dict(
+                year=year,
+                month=month,
+                from_serno=sernos.min() if len(sernos) else '',
+                to_serno=sernos.max() if len(sernos) else '',
+                crms=df.loc[is_crm, 'serno'].tolist(),
+            ))
+        return pd.DataFrame(rows, columns=['year', 'month', 'from_serno', 'to_serno', 'crms'])
+
+    def get_info(self, year: int = None, month: int = None) -> dict:
+        """Same info as HydrofiaExportFileDiscrete.get_info for the samples in the given year and month"""
+        boolean = np.full(len(self._sernos), True)
+        if year:
+            boolean = boolean & (self._sernos['year'] == year)
+        if month:
+            boolean = boolean & (self._sernos['month'] == month)
+        data = self._sernos[boolean]
+        return get_info(sernos=data['serno'], years=data['year'])
+
+    def _load_file(self) -> None:
+        sernos = []
+        with open(self.path) as fid:
+            chunks = pd.read_csv(fid,
+                                 skiprows=[0, 2],
+                                 usecols=self.COLUMNS,
+                                 dtype=str,
+                                 keep_default_na=False,
+                                 chunksize=HydrofiaExportFileDiscrete.CHUNK_SIZE)
+            for chunk in chunks:
+                chunk = chunk[chunk['action'] == 'Measure discrete']
+                parts = chunk['sampleName'].str.extract(HydrofiaExportFileDiscrete.SAMPLE_NAME_PATTERN)
+                df = pd.DataFrame(dict(
+                    year=chunk['timestamp'].str[:4],
+                    month=chunk['timestamp'].str[5:7],
+                    serno=parts['serno'].fillna(parts['crm']),
+                ))
+                sernos.append(df.dropna().drop_duplicates())
+        data = pd.concat(sernos).drop_duplicates() if sernos else pd.DataFrame(columns=['year', 'month', 'serno'])
+        data['year'] = data['year'].astype(int)
+        data['month'] = data['month'].astype(int)
+        self._sernos = data.sort_values(['year', 'month', 'serno']).reset_index(drop=True)
+
+
+def get_export_file_summary(path: str | pathlib.Path) -> HydrofiaExportFileSummary:
+    """Summaries are reused as long as the file is unchanged"""
+    path = pathlib.Path(path).resolve()
+    stat = path.stat()
+    return _get_export_file_summary(path, stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=16)
+def _get_export_file_summary(path: pathlib.Path, size: int, mtime_ns: int) -> HydrofiaExportFileSummary:
+    return HydrofiaExportFileSummary(path)
+
+
+# Loaded template data shared by all templates in the process. The values are (fingerprint, data) and are
+# only used if the fingerprint of the file is unchanged.
+TEMPLATE_DATA_CACHE = cache.MemoryLRUCache(max_entries=cache.TEMPLATE_DATA_CACHE_MAX_ENTRIES)
+
+
 class HydrofiaTemplateData(Protocol):
 
     def get_data(self) -> pd.DataFrame:
@@ -221,6 +736,11 @@ class HyrdofiaExcelTemplate:
         'salinity': 'SALINITY (CRM)',
         # 'temperatureSampleC': 'temperatureSampleC (correct)',
     }
+    # Hidden sheet with the typed rows of the template data. Rows are joined with the template sheet on row id
+    DATA_SHEET_NAME = 'data'
+    ROW_ID_COLUMN = 'row_id'
+    # Column in the data sheet with the ctd data matched when the template was created, see calculate.get_ctd_matches
+    CTD_MATCH_COLUMN = 'ctd_match'
     FILL_USER_ACTION = PatternFill(start_color='faeda2',
                                    end_color='faeda2',
                                    fill_type='solid')
@@ -234,10 +754,14 @@ class HyrdofiaExcelTemplate:
                                  top=Side(style='thin'),
                                  bottom=Side(style='thin'))
 
-    def __init__(self, path):
+    def __init__(self, path, columns: list[str] = None, use_cache: bool = True):
+        """columns limits the loaded data to the given (corrected) columns. All columns are loaded if not given.
+        Loaded data is kept in TEMPLATE_DATA_CACHE and, unless use_cache is False, on disk (see hydrofia.cache)
+        until the template file is changed."""
         self._path = pathlib.Path(path)
         self._template_create = _HyrdofiaExcelTemplateCreate(self)
-        self._template_load = _HyrdofiaExcelTemplateLoad(self)
+        self._template_load = _HyrdofiaExcelTemplateLoad(self, columns=columns, use_cache=use_cache)
+        self._template_corrections = _HyrdofiaExcelTemplateCorrections(self)
 
     @staticmethod
     def get_default_template_path(directory: pathlib.Path | str = None) -> pathlib.Path:
@@ -254,8 +778,10 @@ class HyrdofiaExcelTemplate:
     def path(self):
         return self._path
 
-    def create_template(self, hydrofia: HydrofiaTemplateData, overwrite: bool = False) -> pathlib.Path:
-        return self._template_create.create_template(hydrofia=hydrofia, overwrite=overwrite)
+    def create_template(self, hydrofia: HydrofiaTemplateData, overwrite: bool = False,
+                        ctd_matches: list[dict | None] = None) -> pathlib.Path:
+        """ctd_matches (one per data row) are stored in the template and reused by Calculate"""
+        return self._template_create.create_template(hydrofia=hydrofia, overwrite=overwrite, ctd_matches=ctd_matches)
 
     def open_template(self):
         utils.open_file_in_default_program(self.path)
@@ -267,6 +793,37 @@ class HyrdofiaExcelTemplate:
     def get_data(self):
         return self._template_load.get_data()
 
+    def get_row_hashes(self) -> np.ndarray:
+        return self._template_load.get_row_hashes()
+
+    def get_ctd_matches(self) -> list[dict | None]:
+        return self._template_load.get_ctd_matches()
+
+    def get_corrections(self) -> pd.DataFrame:
+        return self._template_corrections.get_corrections()
+
+    def get_corrected_rows(self) -> list[int]:
+        return self._template_corrections.get_corrected_rows()
+
+    def highlight_corrections(self, path: str | pathlib.Path = None) -> list[int]:
+        return self._template_corrections.highlight_corrections(path=path)
+
+
+def _get_template_values(data: pd.DataFrame) -> tuple[pd.DataFrame, dict[str, np.ndarray]]:
+    """Returns the data as written to a template, with dates as %Y-%m-%d, and the text of the correction columns
+    (keys of HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING). Salinity and temperature are only given for CRM
+    samples."""
+    if pd.api.types.is_datetime64_any_dtype(data['date']):
+        data = data.copy()
+        data['date'] = data['date'].dt.strftime('%Y-%m-%d')
+    is_crm = data['serno'].astype(str).str.contains('CRM', regex=False).values
+    values = {}
+    for key in HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING:
+        values[key] = _HyrdofiaExcelTemplateCreate._get_text_values(data[key])
+        if key == 'salinity' or 'temperature' in key:
+            values[key] = np.where(is_crm, values[key], '')
+    return data, values
+
 
 class _HyrdofiaExcelTemplateCreate:
     FILL_USER_ACTION = PatternFill(start_color='faeda2',
@@ -282,10 +839,15 @@ class _HyrdofiaExcelTemplateCreate:
                                  top=Side(style='thin'),
                                  bottom=Side(style='thin'))
 
+    INFO_TEXT = 'Gå igenom och sätt rätt värde i dessa kolumner!'
+
     def __init__(self, parent: HyrdofiaExcelTemplate):
         self._parent = parent
-        self.wb = Workbook()
-        self.ws = self.wb.active
+        self.wb = None
+        self.ws = None
+        self._data = pd.DataFrame()
+        self._user_values: dict[str, np.ndarray] = {}
+        self._ctd_matches = None
 
     @property
     def path(self):
@@ -293,94 +855,299 @@ class _HyrdofiaExcelTemplateCreate:
 
     @property
     def data(self):
-        return self.hydrofia.get_data()
+        return self._data
 
-    def create_template(self, hydrofia: HydrofiaTemplateData, overwrite: bool = False) -> pathlib.Path:
+    def create_template(self, hydrofia: HydrofiaTemplateData, overwrite: bool = False,
+                        ctd_matches: list[dict | None] = None) -> pathlib.Path:
+        """The workbook is written in write-only mode, i.e. rows are streamed to the file as they are added"""
         self.hydrofia = hydrofia
+        self._ctd_matches = ctd_matches
         if self.path.exists() and not overwrite:
             raise FileExistsError(self.path)
 
+        self._data, self._user_values = _get_template_values(self.hydrofia.get_data())
+
+        self._create_workbook()
+        self._set_column_widths()
+        self._merge_cells()
         self._set_info_header()
         self._set_data_header()
         self._add_data()
-        self._add_correct_data()
-        self._merge_cells()
+        self._add_data_sheet()
         return self._save_file()
 
+    @property
+    def _header(self) -> list[str]:
+        return list(HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING.values()) + list(self.data.columns) + \
+            [HyrdofiaExcelTemplate.ROW_ID_COLUMN]
+
+    def _create_workbook(self):
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet()
+
+    def _get_cell(self, value=None, **kwargs) -> WriteOnlyCell:
+        """kwargs are cell formats, e.g. fill, border and number_format"""
+        cell = WriteOnlyCell(self.ws, value=value)
+        for key, item in kwargs.items():
+            setattr(cell, key, item)
+        return cell
+
+    def _set_column_widths(self):
+        """Column width help at: https://stackoverflow.com/questions/13197574/openpyxl-adjust-column-width-size"""
+        for c, item in enumerate(self._header, 1):
+            self.ws.column_dimensions[get_column_letter(c)].width = len(item)+6
+
     def _set_info_header(self):
-        cell = self.ws.cell(1, 1)
-        cell.value = 'Gå igenom och sätt rätt värde i dessa kolumner!'
-        cell.fill = HyrdofiaExcelTemplate.FILL_USER_ACTION
+        self.ws.append([self._get_cell(self.INFO_TEXT, fill=HyrdofiaExcelTemplate.FILL_USER_ACTION)])
 
     def _set_data_header(self):
-        """Column width help at: https://stackoverflow.com/questions/13197574/openpyxl-adjust-column-width-size"""
-        header = list(HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING.values()) + list(self.data.columns)
-        for c, item in enumerate(header, 1):
-            cell = self.ws.cell(2, c)
-            cell.value = item
-            self.ws.column_dimensions[get_column_letter(c)].width = len(item)+6
-            if c <= len(HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING):
-                cell.fill = HyrdofiaExcelTemplate.FILL_USER_ACTION
+        nr_user_columns = len(HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING)
+        row = []
+        for c, item in enumerate(self._header, 1):
+            if c <= nr_user_columns:
+                row.append(self._get_cell(item, fill=HyrdofiaExcelTemplate.FILL_USER_ACTION))
+            else:
+                row.append(item)
+        self.ws.append(row)
+
+    @staticmethod
+    def _get_text_values(series: pd.Series) -> np.ndarray:
+        """Values of the column as cell text. Missing values are given as empty strings."""
+        return np.where(series.isna(), '', series.astype(str))
 
     def _add_data(self):
-        add_c = len(HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING) + 1
-        r = 3
-        for index, series in self.data.iterrows():
-            for c, value in enumerate(series, add_c):
-                cell = self.ws.cell(r, c)
-                cell.value = str(value)
-                cell.number_format = numbers.FORMAT_TEXT
-            r += 1
-
-    def _add_correct_data(self):
-        r = 3
-        for index, series in self.data.iterrows():
-            for c, key in enumerate(HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING, 1):
-                cell = self.ws.cell(r, c)
-                value = series[key]
-                if key == 'salinity' and 'CRM' not in series['serno']:
-                    value = ''
-                elif 'temperature' in key and 'CRM' not in series['serno']:
-                    value = ''
-                cell.value = str(value)
-                cell.fill = HyrdofiaExcelTemplate.FILL_USER_ACTION
-                cell.border = HyrdofiaExcelTemplate.BORDER_USER_ACTION
-                cell.number_format = numbers.FORMAT_TEXT
-            r += 1
+        """One formatted cell is created per column. Each row sets the cell values and is written on append,
+        so the cells are reused for all rows."""
+        columns = list(self._user_values.values())
+        cells = [self._get_cell(fill=HyrdofiaExcelTemplate.FILL_USER_ACTION,
+                                border=HyrdofiaExcelTemplate.BORDER_USER_ACTION,
+                                number_format=numbers.FORMAT_TEXT) for _ in columns]
+        for col in self.data.columns:
+            columns.append(self._get_text_values(self.data[col]))
+            cells.append(self._get_cell(number_format=numbers.FORMAT_TEXT))
+        columns.append(range(len(self.data)))
+        cells.append(self._get_cell())
+        t0 = time.perf_counter()
+        for values in zip(*columns):
+            for cell, value in zip(cells, values):
+                cell.value = value
+            self.ws.append(cells)
+        seconds = time.perf_counter() - t0
+        nr_rows = len(self.data)
+        logger.debug(f'Added {nr_rows} template rows in {seconds:.2f} s ({nr_rows / max(seconds, 1e-9):.0f} rows/s)')
+
+    @staticmethod
+    def _get_value_type(series: pd.Series) -> str:
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return 'datetime'
+        if pd.api.types.is_bool_dtype(series):
+            return 'str'
+        if pd.api.types.is_integer_dtype(series):
+            return 'int'
+        if pd.api.types.is_float_dtype(series):
+            return 'float'
+        return 'str'
+
+    @staticmethod
+    def _get_typed_values(series: pd.Series, value_type: str) -> list:
+        """Values of the column as json types. Missing values are given as None."""
+        if value_type == 'datetime':
+            series = series.dt.strftime(HydrofiaExportFileDiscrete.TIMESTAMP_FORMAT)
+        elif value_type == 'str':
+            series = series.astype(str).where(series.notna())
+        return series.astype(object).where(series.notna(), None).tolist()
+
+    def _add_data_sheet(self):
+        """Adds a hidden sheet with one json encoded row of typed values per row id"""
+        ws = self.wb.create_sheet(HyrdofiaExcelTemplate.DATA_SHEET_NAME)
+        ws.sheet_state = 'hidden'
+        names = list(self.data.columns)
+        value_types = [self._get_value_type(self.data[col]) for col in self.data.columns]
+        columns = [self._get_typed_values(self.data[col], value_type)
+                   for col, value_type in zip(self.data.columns, value_types)]
+        if self._ctd_matches is not None:
+            names.append(HyrdofiaExcelTemplate.CTD_MATCH_COLUMN)
+            value_types.append('json')
+            columns.append(self._ctd_matches)
+        ws.append([HyrdofiaExcelTemplate.ROW_ID_COLUMN, json.dumps(names)])
+        ws.append(['type', json.dumps(value_types)])
+        for row_id, values in enumerate(zip(*columns)):
+            ws.append([row_id, json.dumps(values)])
 
     def _merge_cells(self):
-        self.ws.merge_cells(start_row=1, end_row=1, start_column=1, end_column=6)
+        self.ws.merged_cells.add(CellRange(min_row=1, max_row=1, min_col=1, max_col=6))
 
     def _save_file(self):
         self.wb.save(self.path)
         return self.path
 
 
-class _HyrdofiaExcelTemplateLoad:
+class _TemplateRows:
+    """Row hashes and ctd matches of loaded template data. get_data() gives the data rows and sets
+    self._ctd_matches, one per data row."""
+    _ctd_matches: list[dict | None]
 
-    def __init__(self, parent: HyrdofiaExcelTemplate):
+    def get_row_hashes(self) -> np.ndarray:
+        """One hash per data row of the correction columns and the raw row. Used to find changed rows."""
+        data = self.get_data().drop(columns='index')
+        return pd.util.hash_pandas_object(data, index=False).values
+
+    def get_ctd_matches(self) -> list[dict | None]:
+        """The ctd data matched when the template was created, one per data row. None where not matched."""
+        self.get_data()
+        return self._ctd_matches
+
+
+class _HyrdofiaExcelTemplateLoad(_TemplateRows):
+    """Reads the template sheet in read-only mode. The user correction columns replace the original
+    columns while the rows are read and only the requested columns are kept in memory. If the template has
+    a data sheet only the correction columns are read from the template sheet and the other columns are
+    taken, typed, from the data sheet."""
+
+    # Increase when the content of the loaded data changes so that old cache entries are not used
+    CACHE_VERSION = 2
+
+    def __init__(self, parent: HyrdofiaExcelTemplate, columns: list[str] = None, use_cache: bool = True):
         self._parent = parent
+        self._columns = columns
+        self._cache = cache.get_template_cache() if use_cache else None
         self._data = pd.DataFrame()
+        self._ctd_matches: list[dict | None] = []
 
     def load(self):
+        fingerprint = self._get_fingerprint()
+        if self._load_from_cache(fingerprint):
+            return
         self._load_template()
-        self._modify_header()
         self._filter_data()
         # self._add_columns()
+        self._save_to_cache(fingerprint)
+
+    @property
+    def _cache_key(self) -> str:
+        return cache.get_key(self.path.resolve(), self._columns)
+
+    def _get_fingerprint(self) -> dict:
+        stat = self.path.stat()
+        return dict(version=self.CACHE_VERSION, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    def _load_from_cache(self, fingerprint: dict) -> bool:
+        data = None
+        entry = TEMPLATE_DATA_CACHE.get(self._cache_key)
+        if entry is not None and entry[0] == fingerprint:
+            data = entry[1]
+        if data is None and self._cache:
+            meta = self._cache.get_meta(self._cache_key)
+            if meta and meta['fingerprint'] == fingerprint:
+                data = self._cache.get_data(self._cache_key)
+            if data is not None:
+                TEMPLATE_DATA_CACHE.put(self._cache_key, (fingerprint, data))
+        if data is None:
+            return False
+        self._data = data.copy()
+        self._ctd_matches = self._data.pop(HyrdofiaExcelTemplate.CTD_MATCH_COLUMN).tolist()
+        return True
+
+    def _save_to_cache(self, fingerprint: dict) -> None:
+        data = self._data.copy()
+        data[HyrdofiaExcelTemplate.CTD_MATCH_COLUMN] = self._ctd_matches
+        TEMPLATE_DATA_CACHE.put(self._cache_key, (fingerprint, data))
+        if self._cache:
+            self._cache.put(self._cache_key, data, dict(path=str(self.path.resolve()), fingerprint=fingerprint))
 
     def _load_template(self):
-        self._data = pd.read_excel(self.path, skiprows=1, dtype=str)
+        reader = _XlsxSheetReader(self.path)
+        header = reader.get_first_row(min_row=2)
+        positions, columns = self._get_column_positions(header)
+        row_id_position = self._get_row_id_position(header)
+        if row_id_position is None or HyrdofiaExcelTemplate.DATA_SHEET_NAME not in reader.get_sheet_names():
+            self._data = self._read_template_columns(reader, positions, columns)
+            self._ctd_matches = [None] * len(self._data)
+            return
+        corrections = [(pos, col) for pos, col in zip(positions, columns)
+                       if col in HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING]
+        corrections.append((row_id_position, HyrdofiaExcelTemplate.ROW_ID_COLUMN))
+        data = self._read_template_columns(reader, [pos for pos, _ in corrections], [col for _, col in corrections])
+        row_ids = pd.to_numeric(data.pop(HyrdofiaExcelTemplate.ROW_ID_COLUMN), errors='coerce')
+        if row_ids.notna().all():
+            row_ids = row_ids.astype(int)
+        typed_data = self._read_data_sheet(reader, [col for col in columns if col not in data])
+        typed_data = typed_data.reindex(row_ids).reset_index(drop=True)
+        for col in data:
+            typed_data[col] = data[col].values
+        self._data = typed_data[columns]
+        self._ctd_matches = [None] * len(self._data)
+        if HyrdofiaExcelTemplate.CTD_MATCH_COLUMN in typed_data:
+            self._ctd_matches = [match if isinstance(match, dict) else None
+                                 for match in typed_data[HyrdofiaExcelTemplate.CTD_MATCH_COLUMN]]
+
+    def _read_template_columns(self, reader: _XlsxSheetReader, positions: list[int],
+                               columns: list[str]) -> pd.DataFrame:
+        records = []
+        for row in reader.iter_rows(min_row=3, columns=set(positions)):
+            if all(value == '' for value in row.values()):
+                continue
+            records.append([self._get_cell_text(row.get(pos)) for pos in positions])
+        return pd.DataFrame(records, columns=columns, dtype=object)
+
+    def _read_data_sheet(self, reader: _XlsxSheetReader, columns: list[str]) -> pd.DataFrame:
+        """Returns the given columns, and the ctd matches if present, of the data sheet with the row id as index"""
+        rows = reader.iter_rows(sheet_name=HyrdofiaExcelTemplate.DATA_SHEET_NAME)
+        names = json.loads(next(rows)[1])
+        value_types = dict(zip(names, json.loads(next(rows)[1])))
+        if HyrdofiaExcelTemplate.CTD_MATCH_COLUMN in names:
+            columns = [*columns, HyrdofiaExcelTemplate.CTD_MATCH_COLUMN]
+        row_ids = []
+        records = []
+        for row in rows:
+            row_ids.append(row[0])
+            records.append(json.loads(row[1]))
+        data = pd.DataFrame(records, columns=names, index=row_ids)[columns]
+        for col in columns:
+            if value_types[col] == 'datetime':
+                data[col] = pd.to_datetime(data[col], format=HydrofiaExportFileDiscrete.TIMESTAMP_FORMAT)
+            elif value_types[col] == 'float':
+                data[col] = data[col].astype(float)
+            elif value_types[col] == 'str':
+                data[col] = data[col].astype(object).where(data[col].notna(), np.nan)
+        return data
 
-    def _modify_header(self):
-        for col in HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING:
-            self._data.drop(col, inplace=True, axis=1)
+    @staticmethod
+    def _get_row_id_position(header: dict[int, object]) -> int | None:
+        for pos, col in header.items():
+            if col == HyrdofiaExcelTemplate.ROW_ID_COLUMN:
+                return pos
+        return None
+
+    def _get_column_positions(self, header: dict[int, object]) -> tuple[list[int], list[str]]:
+        """Returns the sheet positions and the names of the columns to read. Correction headers are
+        given the name of the column they correct and the original column is skipped."""
         mapper = dict((value, key) for key, value in HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING.items())
-        self._data.rename(columns=mapper, inplace=True)
+        names = {}
+        for pos, col in sorted(header.items()):
+            if col in HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING or col == HyrdofiaExcelTemplate.ROW_ID_COLUMN:
+                continue
+            name = mapper.get(col, col)
+            if self._columns and name not in self._columns and name != 'depth':
+                continue
+            names[name] = pos
+        if self._columns:
+            names = dict((col, names[col]) for col in [*self._columns, 'depth'] if col in names)
+        return list(names.values()), list(names)
+
+    @staticmethod
+    def _get_cell_text(value) -> str | float:
+        if value is None or value == '':
+            return np.nan
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
 
     def _filter_data(self):
         boolean = self._data['depth'].apply(lambda x: str(x).upper()) == 'X'
         self._data = self._data[~boolean]
         self._data.reset_index(inplace=True)
+        self._ctd_matches = [match for match, remove in zip(self._ctd_matches, boolean) if not remove]
 
     def _add_columns(self):
         self._data['year'] = self._data['date'].apply(lambda x: x.year)
@@ -400,5 +1167,181 @@ class _HyrdofiaExcelTemplateLoad:
         return self.data
 
 
+class _HyrdofiaExcelTemplateCorrections:
+    """Compares the user correction columns with the original columns of the template sheet"""
+
+    def __init__(self, parent: HyrdofiaExcelTemplate):
+        self._parent = parent
+
+    @property
+    def path(self):
+        return self._parent.path
+
+    def get_corrections(self) -> pd.DataFrame:
+        """Returns a boolean frame, with one column per corrected column, that is True where the user has
+        changed the value. The index is the row number in the template sheet."""
+        reader = _XlsxSheetReader(self.path)
+        header = dict((col, pos) for pos, col in reader.get_first_row(min_row=2).items())
+        keys = list(HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING)
+        positions = [header[HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING[key]] for key in keys] + \
+                    [header[key] for key in keys]
+        row_numbers = []
+        records = []
+        for row_number, row in reader.iter_numbered_rows(min_row=3, columns=set(positions)):
+            row_numbers.append(row_number)
+            records.append([self._get_text(row.get(pos)) for pos in positions])
+        values = np.array(records, dtype=object).reshape(len(records), len(positions))
+        corrected = values[:, :len(keys)]
+        # The correction columns as given when the template was created from the original columns
+        _, original = _get_template_values(pd.DataFrame(values[:, len(keys):], columns=keys))
+        differ = dict((key, corrected[:, i] != original[key]) for i, key in enumerate(keys))
+        return pd.DataFrame(differ, columns=keys, index=pd.Index(row_numbers, name='row'))
+
+    @staticmethod
+    def _get_text(value) -> str:
+        text = _HyrdofiaExcelTemplateLoad._get_cell_text(value)
+        if not isinstance(text, str):
+            return ''
+        return text.strip()
+
+    def get_corrected_rows(self) -> list[int]:
+        """Returns the template sheet row numbers where any value has been corrected"""
+        corrections = self.get_corrections()
+        return corrections.index[corrections.any(axis=1)].tolist()
+
+    def highlight_corrections(self, path: str | pathlib.Path = None) -> list[int]:
+        """Saves the template to path (the template itself if not given) with the corrected cells filled with
+        FILL_USER_ACTION_DIFFER. Returns the corrected row numbers."""
+        corrections = self.get_corrections()
+        wb = load_workbook(self.path)
+        ws = wb.worksheets[0]
+        header = dict((cell.value, cell.column) for cell in ws[2])
+        for key in corrections.columns:
+            col = header[HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING[key]]
+            for row_number, differ in corrections[key].items():
+                if differ:
+                    ws.cell(row_number, col).fill = HyrdofiaExcelTemplate.FILL_USER_ACTION_DIFFER
+                else:
+                    ws.cell(row_number, col).fill = HyrdofiaExcelTemplate.FILL_USER_ACTION
+        wb.save(path or self.path)
+        return corrections.index[corrections.any(axis=1)].tolist()
+
+
+class _HydrofiaFileTemplate(_TemplateRows, abc.ABC):
+    """Template with the same columns as HyrdofiaExcelTemplate written to a plain file. Used in automated
+    runs where the template is not edited by hand. Subclasses write and read the template frame."""
+    SUFFIXES: list[str] = []
+
+    def __init__(self, path: str | pathlib.Path):
+        self._path = pathlib.Path(path)
+        self._data = pd.DataFrame()
+        self._ctd_matches: list[dict | None] = []
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def data(self):
+        return self.get_data()
+
+    def create_template(self, hydrofia: HydrofiaTemplateData, overwrite: bool = False,
+                        ctd_matches: list[dict | None] = None) -> pathlib.Path:
+        """ctd_matches (one per data row) are stored json encoded in the template and reused by Calculate"""
+        if self.path.exists() and not overwrite:
+            raise FileExistsError(self.path)
+        frame = self._get_template_frame(hydrofia.get_data())
+        if ctd_matches is not None:
+            frame[HyrdofiaExcelTemplate.CTD_MATCH_COLUMN] = [json.dumps(match) for match in ctd_matches]
+        self._write(frame)
+        self._data = pd.DataFrame()
+        return self.path
 
+    def get_data(self) -> pd.DataFrame:
+        if self._data.empty:
+            frame = self._read()
+            self._ctd_matches = [None] * len(frame)
+            if HyrdofiaExcelTemplate.CTD_MATCH_COLUMN in frame:
+                self._ctd_matches = [json.loads(value) if isinstance(value, str) else None
+                                     for value in frame.pop(HyrdofiaExcelTemplate.CTD_MATCH_COLUMN)]
+            depth = frame[HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING['depth']]
+            keep = (depth.astype(str).str.upper() != 'X').values
+            self._ctd_matches = [match for match, k in zip(self._ctd_matches, keep) if k]
+            self._data = self._get_data_from_template_frame(frame[keep])
+        return self._data
+
+    @abc.abstractmethod
+    def _write(self, frame: pd.DataFrame) -> None:
+        ...
+
+    @abc.abstractmethod
+    def _read(self) -> pd.DataFrame:
+        ...
+
+    @staticmethod
+    def _get_template_frame(data: pd.DataFrame) -> pd.DataFrame:
+        """Correction columns (as text) first, then the data columns and the row id"""
+        data, values = _get_template_values(data)
+        columns = dict((header, values[key]) for key, header in HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING.items())
+        frame = pd.DataFrame(columns, index=data.index)
+        frame = pd.concat([frame, data], axis=1).reset_index(drop=True)
+        frame[HyrdofiaExcelTemplate.ROW_ID_COLUMN] = range(len(frame))
+        return frame
 
+    @staticmethod
+    def _get_data_from_template_frame(frame: pd.DataFrame) -> pd.DataFrame:
+        """Same data as loaded from a HyrdofiaExcelTemplate"""
+        mapper = dict((value, key) for key, value in HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING.items())
+        data = frame.drop(columns=[*HyrdofiaExcelTemplate.ADDITIONAL_HEADER_MAPPING,
+                                   HyrdofiaExcelTemplate.ROW_ID_COLUMN])
+        data = data.rename(columns=mapper)
+        for col in mapper.values():
+            data[col] = data[col].where(data[col] != '', np.nan)
+        return data.reset_index()
+
+
+class HydrofiaTextTemplate(_HydrofiaFileTemplate):
+    """Template as a text file. Tab separated for .tsv and .txt, otherwise comma separated.
+    All values are read back as text, as from the Excel template sheet."""
+    SUFFIXES = ['.csv', '.tsv', '.txt']
+    ENCODING = 'utf-8'
+
+    def __init__(self, path: str | pathlib.Path, sep: str = None):
+        super().__init__(path)
+        self._sep = sep or ('\t' if self.path.suffix.lower() in ['.tsv', '.txt'] else ',')
+
+    def _write(self, frame: pd.DataFrame) -> None:
+        frame.to_csv(self.path, sep=self._sep, index=False, encoding=self.ENCODING)
+
+    def _read(self) -> pd.DataFrame:
+        frame = pd.read_csv(self.path, sep=self._sep, dtype=str, keep_default_na=False, encoding=self.ENCODING)
+        return frame.where(frame != '', np.nan)
+
+
+class HydrofiaPickleTemplate(_HydrofiaFileTemplate):
+    """Template as a pandas pickle file. Data columns keep their types. Pickle is used since pyarrow
+    (needed for feather and parquet) is not a dependency of hydrofia. A pickle file is tied to the pandas
+    version that wrote it and may not be readable with another version, so only use it for templates that
+    are created and calculated with the same installation. Use HydrofiaTextTemplate to share templates."""
+    SUFFIXES = ['.pkl', '.pickle']
+
+    def _write(self, frame: pd.DataFrame) -> None:
+        frame.to_pickle(self.path)
+
+    def _read(self) -> pd.DataFrame:
+        if not self.path.exists():
+            raise FileNotFoundError(self.path)
+        try:
+            return pd.read_pickle(self.path)
+        except Exception as e:
+            raise ValueError(f'Could not read pickle template {self.path}. It may have been written with another '
+                             f'version of pandas (this is {pd.__version__}), create the template again: {e}') from e
+
+
+def get_template(path: str | pathlib.Path) -> HyrdofiaExcelTemplate | HydrofiaTextTemplate | HydrofiaPickleTemplate:
+    """Returns the template backend matching the suffix of path. Excel is used for unknown suffixes."""
+    suffix = pathlib.Path(path).suffix.lower()
+    for cls in [HydrofiaTextTemplate, HydrofiaPickleTemplate]:
+        if suffix in cls.SUFFIXES:
+            return cls(path)
+    return HyrdofiaExcelTemplate(path)
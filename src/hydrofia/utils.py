@@ -1,6 +1,7 @@
 import datetime
 import calendar
 import os
+import pathlib
 import platform
 import subprocess
 
@@ -34,5 +35,11 @@ def get_date_limits_from_year_and_month(year: int = None, month: int = None):
     return start_date, end_date
 
 
-
-
+def get_user_cache_directory() -> pathlib.Path:
+    if platform.system() == 'Darwin':  # macOS
+        root = pathlib.Path.home() / 'Library' / 'Caches'
+    elif platform.system() == 'Windows':  # Windows
+        root = os.environ.get('LOCALAPPDATA') or pathlib.Path.home() / 'AppData' / 'Local'
+    else:  # linux variants
+        root = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(root, 'hydrofia')
@@ -0,0 +1,31 @@
+import pandas as pd
+
+from hydrofia.calculate import get_ctd_lookup
+from hydrofia.calculate import get_ctd_matches
+
+
+class _CtdData:
+
+    def get_file_fingerprint(self, year=None, ship=None, serno=None):
+        return 'fingerprint'
+
+    def get_ctd_data(self, year=None, ship=None, serno=None, depth=None):
+        return dict(salt=7.0, temp=10.0, depth=depth, station='STATION')
+
+
+def _get_row(depth, serno='0001') -> pd.Series:
+    return pd.Series(dict(year=2023, country='77', ship='10', serno=serno, depth=depth))
+
+
+def test_ctd_lookup_depth():
+    assert get_ctd_lookup(_get_row(5.0))['depth'] == 5.0
+    assert get_ctd_lookup(_get_row('10/2'))['depth'] == 10.0
+    assert get_ctd_lookup(_get_row('DIB'))['depth'] == 'deepest'
+    assert get_ctd_lookup(_get_row('abc'))['depth'] == 'abc'
+    assert get_ctd_lookup(_get_row(5.0, serno='CRM185')) is None
+
+
+def test_ctd_matches_for_replicates():
+    data = pd.DataFrame([_get_row(depth) for depth in ['5', '10/2', 'DIB', 'abc']])
+    matches = get_ctd_matches(data, _CtdData())
+    assert [match['data']['depth'] if match else None for match in matches] == [5.0, 10.0, 'deepest', None]
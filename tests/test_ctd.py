@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+import hydrofia
+from hydrofia import cache
+from hydrofia.ctd import CtdProfile
+from hydrofia.ctd import CtdStandardFormat
+from hydrofia.ctd import CtdStandardFormatCollection
+from hydrofia.hydrofia import TEMPLATE_DATA_CACHE
+
+CTD_HEADER = ['MYEAR', 'SHIPC', 'DEPH [m]', 'QV:SMHI:DEPH [m]', 'TEMP_CTD [°C (ITS-90)]',
+              'QV:SMHI:TEMP2_CTD [°C (ITS-90)]', 'SALT_CTD [psu]', 'QV:SMHI:SALT_CTD [psu]', 'COMNT_SAMP']
+
+
+def write_ctd_file(directory, serno: str, rows: list[tuple[float, float, float, str]]):
+    """rows are (depth, salt, temp, salt quality flag) in file order"""
+    path = directory / f'SBE09_1044_20230502_1421_77SE_02_{serno}.txt'
+    lines = ['//METADATA;DELIMITERS;\\t', f'//METADATA;STATN;STATION {serno}', '\t'.join(CTD_HEADER)]
+    for depth, salt, temp, flag in rows:
+        lines.append('\t'.join(['2023', '77SE', str(depth), '', str(temp), '', str(salt), flag, 'a/b']))
+    path.write_text('\n'.join(lines) + '\n', encoding='cp1252')
+    return path
+
+
+@pytest.fixture
+def ctd_directory(tmp_path):
+    directory = tmp_path / 'ctd'
+    directory.mkdir()
+    # Down and up cast with equal depths and a flagged value
+    write_ctd_file(directory, '0001', [(1.0, 7.0, 10.0, ''), (2.0, 7.1, 9.0, ''), (3.0, 7.2, 8.0, ''),
+                                       (4.0, 9.9, 9.9, 'B'), (5.0, 7.4, 6.0, ''), (3.0, 7.5, 5.0, ''),
+                                       (2.5, 7.6, 4.0, '')])
+    write_ctd_file(directory, '0006', [(1.0, 7.0, 10.0, ''), (2.0, 7.1, 9.0, '')])
+    return directory
+
+
+def test_nearest_depth_and_ties(ctd_directory):
+    ctd = CtdStandardFormat(next(ctd_directory.glob('*0001.txt')))
+    assert ctd.get_last_data_at_depth(1.2)['salt'] == 7.0
+    # Equal depths and equally near depths give the row first in the file
+    assert ctd.get_last_data_at_depth(3)['salt'] == 7.2
+    assert ctd.get_last_data_at_depth(2.25)['salt'] == 7.1
+    assert ctd.get_last_data_at_depth(2.75)['salt'] == 7.2
+    # Flagged rows are not used
+    assert ctd.get_last_data_at_depth(4.1)['salt'] == 7.4
+    assert ctd.get_last_data_at_depth('deepest') == dict(salt=7.4, temp=6.0, depth=5.0, station='STATION 0001')
+    assert ctd.get_last_data_at_depth('2.5')['salt'] == 7.6
+    assert ctd.get_last_data_at_depth(8, max_depth_diff_allowed=2) == {}
+    assert ctd.get_last_data_at_depth(0, surface_layer_depth=1.5, max_depth_diff_allowed=0.5)['salt'] == 7.0
+
+
+def test_missing_depth_gives_no_data(ctd_directory):
+    ctd = CtdStandardFormat(next(ctd_directory.glob('*0001.txt')))
+    assert ctd.get_last_data_at_depth(np.nan) == {}
+    assert ctd.get_last_data_at_depth(np.nan, surface_layer_depth=2, bottom_layer_depth=2) == {}
+    collection = CtdStandardFormatCollection(ctd_directory)
+    assert collection.get_ctd_data(year=2023, ship='7710', serno='0001', depth=np.nan) == {}
+    assert len(collection.query_cache) == 0
+
+
+def test_profile_without_depths():
+    profile = CtdProfile.from_arrays(np.array([np.nan]), np.array([7.0]), np.array([10.0]))
+    assert len(profile) == 0
+    assert profile.get_position_at_depth(1.0) is None
+    assert profile.get_position_at_deepest_depth() is None
+
+
+def test_calculate_with_missing_depth(ctd_directory, tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'EXPORT_FILE_CACHE_DIRECTORY', tmp_path / 'cache' / 'export_files')
+    monkeypatch.setattr(cache, 'TEMPLATE_CACHE_DIRECTORY', tmp_path / 'cache' / 'templates')
+    monkeypatch.setattr(cache, 'RESULT_CACHE_DIRECTORY', tmp_path / 'cache' / 'results')
+    TEMPLATE_DATA_CACHE.clear()
+    export_path = tmp_path / 'export.txt'
+    export_path.write_text('\n'.join([
+        'HydroFIA pH export,,,,,,,,',
+        'timestamp,action,sampleName,absorbance578,absorbance434,absorbance730,temperatureSample,salinity,pHT',
+        ',,,AU,AU,AU,degC,psu,',
+        '2023-05-02T08:00:00,Measure discrete,20237710-0006-2,0.7512,0.6021,0.00123,20.70,7.123,7.9012',
+        '2023-05-02T08:10:00,Measure discrete,20237710-0006-,0.7412,0.6121,0.00133,20.60,7.223,7.9112',
+    ]) + '\n')
+    template_path = hydrofia.create_template(tmp_path / 'template.xlsx', export_path, year=2023,
+                                             ctd_directory=ctd_directory)
+    data = hydrofia.get_calculated_object(template_path, ctd_directory).data
+    TEMPLATE_DATA_CACHE.clear()
+    assert list(data['salt']) == [7.1, '']
+    assert list(data['ref_depth']) == [2.0, '']
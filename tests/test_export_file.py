@@ -0,0 +1,147 @@
+import pandas as pd
+import pytest
+
+from hydrofia import cache
+from hydrofia.hydrofia import HydrofiaExportFileCollection
+from hydrofia.hydrofia import HydrofiaExportFileDiscrete
+
+HEADER_LINES = [
+    'HydroFIA pH export,,,,,,,,',
+    'timestamp,action,sampleName,absorbance578,absorbance434,absorbance730,temperatureSample,salinity,pHT',
+    ',,,AU,AU,AU,degC,psu,',
+]
+
+
+def get_data_line(i: int, action: str = 'Measure discrete') -> str:
+    sample_name = f'CRM{100 + i}' if i % 5 == 0 else f'20237710-{i:04d}-{i % 30}'
+    return f'2023-05-{1 + i // 48:02d}T{i % 24:02d}:{i % 60:02d}:00,{action},{sample_name},' \
+           f'0.{7000 + i},0.{6000 + i},0.00123,{15 + i / 10:.2f},{30 + i / 100:.3f},7.9012'
+
+
+def get_data_lines(start: int, stop: int) -> list[str]:
+    return [get_data_line(i, action='Flush' if i % 7 == 0 else 'Measure discrete') for i in range(start, stop)]
+
+
+def write(path, lines: list[str], end: str = '\n') -> None:
+    path.write_text('\n'.join(lines) + end)
+
+
+def append(path, text: str) -> None:
+    with open(path, 'a') as fid:
+        fid.write(text)
+
+
+def assert_same_as_full_parse(export_file: HydrofiaExportFileDiscrete) -> None:
+    expected = HydrofiaExportFileDiscrete(export_file.path, use_cache=False).get_data()
+    assert not expected.empty
+    pd.testing.assert_frame_equal(export_file.get_data(), expected)
+
+
+@pytest.fixture(autouse=True)
+def cache_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'EXPORT_FILE_CACHE_DIRECTORY', tmp_path / 'cache')
+
+
+@pytest.fixture
+def parse_calls(monkeypatch):
+    """Records the previous_data argument (None for a full parse) of each HydrofiaExportFileDiscrete._parse call"""
+    calls = []
+    parse = HydrofiaExportFileDiscrete._parse
+
+    def recording_parse(self, fingerprint, previous_data=None):
+        calls.append(previous_data)
+        return parse(self, fingerprint, previous_data=previous_data)
+
+    monkeypatch.setattr(HydrofiaExportFileDiscrete, '_parse', recording_parse)
+    return calls
+
+
+def test_appended_lines(tmp_path, parse_calls):
+    path = tmp_path / 'export.txt'
+    write(path, HEADER_LINES + get_data_lines(0, 40))
+    export_file = HydrofiaExportFileDiscrete(path)
+    append(path, '\n'.join(get_data_lines(40, 100)) + '\n')
+    export_file.update()
+    assert parse_calls[-1] is not None
+    assert_same_as_full_parse(export_file)
+    # Nothing to do when the file is unchanged
+    nr_calls = len(parse_calls)
+    export_file.update()
+    assert len(parse_calls) == nr_calls
+
+
+def test_partly_written_last_line(tmp_path, parse_calls):
+    path = tmp_path / 'export.txt'
+    last_line = get_data_line(40)
+    write(path, HEADER_LINES + get_data_lines(0, 40) + [last_line[:25]], end='')
+    export_file = HydrofiaExportFileDiscrete(path)
+    assert len(export_file.get_data()) == len(HydrofiaExportFileDiscrete(path, use_cache=False).get_data())
+    assert not (export_file.get_data()['sampleName'] == 'CRM140').any()
+
+    append(path, last_line[25:] + '\n')
+    export_file.update()
+    assert parse_calls[-1] is not None
+    assert (export_file.get_data()['sampleName'] == 'CRM140').any()
+    assert_same_as_full_parse(export_file)
+
+
+def test_reopen_from_cache(tmp_path, parse_calls):
+    path = tmp_path / 'export.txt'
+    write(path, HEADER_LINES + get_data_lines(0, 40))
+    HydrofiaExportFileDiscrete(path)
+    assert parse_calls == [None]
+
+    # Unchanged file is not parsed again
+    assert_same_as_full_parse(HydrofiaExportFileDiscrete(path))
+    parse_calls.clear()
+    reopened = HydrofiaExportFileDiscrete(path)
+    assert parse_calls == []
+
+    append(path, '\n'.join(get_data_lines(40, 100)) + '\n')
+    reopened = HydrofiaExportFileDiscrete(path)
+    assert len(parse_calls) == 1 and parse_calls[0] is not None
+    assert_same_as_full_parse(reopened)
+
+
+def test_rewritten_prefix_forces_full_parse(tmp_path, parse_calls):
+    path = tmp_path / 'export.txt'
+    lines = HEADER_LINES + get_data_lines(0, 40)
+    write(path, lines)
+    export_file = HydrofiaExportFileDiscrete(path)
+
+    # The file is rewritten with a changed line in the already parsed part and more lines at the end
+    lines[5] = get_data_line(99)
+    write(path, lines + get_data_lines(40, 60))
+    export_file.update()
+    assert parse_calls[-1] is None
+    assert (export_file.get_data()['sampleName'] == get_data_line(99).split(',')[2]).any()
+    assert_same_as_full_parse(export_file)
+
+    # Same for a reopen from the cache
+    lines[6] = get_data_line(98)
+    write(path, lines + get_data_lines(40, 60))
+    parse_calls.clear()
+    reopened = HydrofiaExportFileDiscrete(path)
+    assert parse_calls == [None]
+    assert_same_as_full_parse(reopened)
+
+
+def test_collection_skips_files_that_are_not_export_files(tmp_path):
+    write(tmp_path / 'export_1.txt', HEADER_LINES + get_data_lines(0, 40))
+    write(tmp_path / 'export_2.txt', HEADER_LINES + get_data_lines(30, 60))
+    write(tmp_path / 'readme.txt', ['Export files from the instrument'])
+    write(tmp_path / 'archive.txt', ['\t'.join(['country', 'ship', 'serno']), '77\t10\t0001'])
+    collection = HydrofiaExportFileCollection(tmp_path, use_cache=False)
+    assert collection.paths == [tmp_path / 'export_1.txt', tmp_path / 'export_2.txt']
+    assert collection.skipped_paths == [tmp_path / 'archive.txt', tmp_path / 'readme.txt']
+    full = HydrofiaExportFileDiscrete(tmp_path / 'export_1.txt', use_cache=False).get_data()
+    assert len(collection.get_data()) > len(full)
+    assert not collection.get_data().duplicated(subset=['timestamp', 'sampleName']).any()
+
+
+def test_collection_without_export_files(tmp_path):
+    write(tmp_path / 'readme.txt', ['Export files from the instrument'])
+    with pytest.raises(ValueError, match='readme.txt'):
+        HydrofiaExportFileCollection(tmp_path, use_cache=False)
+    with pytest.raises(ValueError, match='readme.txt'):
+        HydrofiaExportFileDiscrete(tmp_path / 'readme.txt', use_cache=False)
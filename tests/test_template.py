@@ -0,0 +1,183 @@
+import datetime
+import html
+import re
+import zipfile
+
+import openpyxl
+import pandas as pd
+import pytest
+from openpyxl.utils.datetime import CALENDAR_MAC_1904
+
+import hydrofia
+from hydrofia import cache
+from hydrofia.hydrofia import TEMPLATE_DATA_CACHE
+from hydrofia.hydrofia import HydrofiaPickleTemplate
+from hydrofia.hydrofia import HyrdofiaExcelTemplate
+from hydrofia.hydrofia import _XlsxSheetReader
+
+EXPORT_FILE_LINES = [
+    'HydroFIA pH export,,,,,,,,',
+    'timestamp,action,sampleName,absorbance578,absorbance434,absorbance730,temperatureSample,salinity,pHT',
+    ',,,AU,AU,AU,degC,psu,',
+    '2023-05-02T08:00:00,Measure discrete,20237710-0001-5,0.7512,0.6021,0.00123,20.70,7.123,7.9012',
+    '2023-05-02T08:10:00,Measure discrete,20237710-0001-10,0.7412,0.6121,0.00133,20.60,7.223,7.9112',
+    '2023-05-02T08:20:00,Flush,20237710-0001-10,0.7412,0.6121,0.00133,20.60,7.223,7.9112',
+    '2023-05-02T08:30:00,Measure discrete,CRM185,0.8012,0.5021,0.00103,25.00,33.456,7.8812',
+    '2023-05-02T08:40:00,Measure discrete,20237710-0002-x,0.8012,0.5021,0.00103,25.00,33.456,7.8812',
+]
+
+
+@pytest.fixture(autouse=True)
+def cache_directories(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'EXPORT_FILE_CACHE_DIRECTORY', tmp_path / 'cache' / 'export_files')
+    monkeypatch.setattr(cache, 'TEMPLATE_CACHE_DIRECTORY', tmp_path / 'cache' / 'templates')
+    monkeypatch.setattr(cache, 'RESULT_CACHE_DIRECTORY', tmp_path / 'cache' / 'results')
+    TEMPLATE_DATA_CACHE.clear()
+    yield
+    TEMPLATE_DATA_CACHE.clear()
+
+
+@pytest.fixture
+def template_path(tmp_path):
+    export_path = tmp_path / 'export.txt'
+    export_path.write_text('\n'.join(EXPORT_FILE_LINES) + '\n')
+    return hydrofia.create_template(tmp_path / 'template.xlsx', export_path, year=2023)
+
+
+def get_column_letters(path) -> dict[str, str]:
+    ws = openpyxl.load_workbook(path).active
+    return dict((cell.value, cell.column_letter) for cell in ws[2])
+
+
+def to_shared_strings(path, save_path, part_name: str = 'xl/sharedStrings.xml') -> None:
+    """Rewrites the inline strings of the first sheet as shared strings, the way Excel stores them.
+    The first string is stored as rich text runs with a phonetic run that is not part of the value."""
+    with zipfile.ZipFile(path) as archive:
+        files = dict((name, archive.read(name)) for name in archive.namelist())
+    strings = []
+
+    def replace(match):
+        strings.append(html.unescape(match.group(2)))
+        return f'{match.group(1)}t="s"><v>{len(strings) - 1}</v>'
+
+    sheet = files['xl/worksheets/sheet1.xml'].decode()
+    sheet = re.sub(r'(<c [^>]*?)t="inlineStr"><is><t>(.*?)</t></is>', replace, sheet)
+    assert 'inlineStr"><is>' not in sheet
+    items = [f'<si><t>{html.escape(text)}</t></si>' for text in strings]
+    items[0] = f'<si><r><t>{html.escape(strings[0][:3])}</t></r><r><t>{html.escape(strings[0][3:])}</t></r>' \
+               f'<rPh sb="0" eb="1"><t>x</t></rPh></si>'
+    files['xl/worksheets/sheet1.xml'] = sheet.encode()
+    files[part_name] = (
+        '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        f'count="{len(strings)}" uniqueCount="{len(strings)}">{"".join(items)}</sst>').encode()
+    files['[Content_Types].xml'] = files['[Content_Types].xml'].replace(
+        b'</Types>',
+        f'<Override PartName="/{part_name}" '.encode() +
+        b'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/></Types>')
+    files['xl/_rels/workbook.xml.rels'] = files['xl/_rels/workbook.xml.rels'].replace(
+        b'</Relationships>',
+        f'<Relationship Id="rIdSharedStrings" Target="/{part_name}" '.encode() +
+        b'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings"/></Relationships>')
+    with zipfile.ZipFile(save_path, 'w') as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+
+
+def test_created_template_round_trip(template_path):
+    data = HyrdofiaExcelTemplate(template_path, use_cache=False).get_data()
+    # The flush row and the row with depth x are not loaded
+    assert list(data['sampleName']) == ['20237710-0001-5', '20237710-0001-10', 'CRM185']
+    assert list(data['serno']) == ['0001', '0001', 'CRM185']
+    assert list(data['depth'][:2]) == ['5', '10']
+    assert list(data['date']) == ['2023-05-02'] * 3
+    assert list(data['timestamp']) == list(pd.to_datetime(['2023-05-02 08:00', '2023-05-02 08:10',
+                                                           '2023-05-02 08:30']))
+    assert list(data['temperatureSample']) == [20.7, 20.6, 25.0]
+    assert list(data['Rspec']) == [0.7512 / 0.6021, 0.7412 / 0.6121, 0.8012 / 0.5021]
+    # Salinity is only given for CRMs
+    assert data['salinity'][:2].isna().all()
+    assert data['salinity'][2] == '33.456'
+    assert not hydrofia.get_template_corrections(template_path).any().any()
+
+
+def test_created_template_is_read_as_openpyxl_reads_it(template_path):
+    ws = openpyxl.load_workbook(template_path).active
+    expected = [dict((c, value) for c, value in enumerate(row) if value is not None)
+                for row in ws.iter_rows(min_row=2, values_only=True)]
+    # Empty inline strings are read as '' where openpyxl gives None
+    rows = [dict((c, value) for c, value in row.items() if value != '')
+            for row in _XlsxSheetReader(template_path).iter_rows(min_row=2)]
+    assert rows == expected
+
+
+def test_template_saved_with_corrections(template_path, tmp_path):
+    letters = get_column_letters(template_path)
+    wb = openpyxl.load_workbook(template_path)
+    ws = wb.active
+    # A date typed into a correction cell, numeric corrections and an untouched text cell
+    ws[f'{letters["DATE (correct)"]}3'] = datetime.datetime(2023, 5, 3)
+    ws[f'{letters["DEPTH (correct)"]}3'] = 7.5
+    ws[f'{letters["DEPTH (correct)"]}4'] = 12
+    ws[f'{letters["SALINITY (CRM)"]}5'] = 33.5
+    saved_path = tmp_path / 'saved.xlsx'
+    wb.save(saved_path)
+    excel_path = tmp_path / 'excel.xlsx'
+    to_shared_strings(saved_path, excel_path)
+
+    for path in [saved_path, excel_path]:
+        data = HyrdofiaExcelTemplate(path, use_cache=False).get_data()
+        assert list(data['date']) == ['2023-05-03 00:00:00', '2023-05-02', '2023-05-02']
+        assert list(data['depth'][:2]) == ['7.5', '12']
+        assert data['salinity'][2] == '33.5'
+        assert list(data['country'][:2]) == ['77', '77'] and pd.isna(data['country'][2])
+        assert list(data['sampleName']) == ['20237710-0001-5', '20237710-0001-10', 'CRM185']
+        corrections = hydrofia.get_template_corrections(path)
+        assert corrections.loc[3, 'date'] and corrections.loc[3, 'depth']
+        assert corrections.loc[4, 'depth']
+        assert corrections.loc[5, 'salinity']
+        assert corrections.sum().sum() == 4
+
+
+@pytest.mark.parametrize('part_name', ['xl/sharedStrings.xml', 'xl/strings/shared.xml'])
+def test_shared_strings_are_read(template_path, tmp_path, part_name):
+    excel_path = tmp_path / 'excel.xlsx'
+    to_shared_strings(template_path, excel_path, part_name=part_name)
+    with zipfile.ZipFile(excel_path) as archive:
+        assert part_name in archive.namelist()
+    reader = _XlsxSheetReader(excel_path)
+    assert list(reader.iter_rows()) == list(_XlsxSheetReader(template_path).iter_rows())
+    assert reader.get_sheet_names() == ['Sheet', HyrdofiaExcelTemplate.DATA_SHEET_NAME]
+
+
+def test_unreadable_pickle_template(tmp_path):
+    path = tmp_path / 'template.pkl'
+    path.write_bytes(b'not a pickle file')
+    with pytest.raises(ValueError, match='template.pkl'):
+        HydrofiaPickleTemplate(path).get_data()
+    with pytest.raises(FileNotFoundError):
+        HydrofiaPickleTemplate(tmp_path / 'missing.pkl').get_data()
+
+
+@pytest.mark.parametrize('epoch', [None, CALENDAR_MAC_1904])
+def test_reader_values(tmp_path, epoch):
+    wb = openpyxl.Workbook()
+    if epoch:
+        wb.epoch = epoch
+    ws = wb.active
+    ws.append(['text', 1, 2.5, True, datetime.datetime(2023, 5, 3, 12, 30), datetime.date(2023, 5, 4)])
+    ws.append([None, None, 'x'])
+    ws['B4'] = 0.1
+    path = tmp_path / 'values.xlsx'
+    wb.save(path)
+
+    reader = _XlsxSheetReader(path)
+    assert list(reader.iter_numbered_rows()) == [
+        (1, {0: 'text', 1: 1, 2: 2.5, 3: True, 4: datetime.datetime(2023, 5, 3, 12, 30),
+             5: datetime.datetime(2023, 5, 4)}),
+        (2, {2: 'x'}),
+        (4, {1: 0.1}),
+    ]
+    assert list(reader.iter_rows(min_row=2, columns={1})) == [{1: 0.1}]
+    assert reader.get_first_row() == reader.get_first_row(sheet_name='Sheet')
+    with pytest.raises(KeyError):
+        reader.get_first_row(sheet_name='missing')